@@ -15,6 +15,9 @@ class Settings(BaseSettings):
     MONGODB_URI: str = os.getenv("MONGODB_URI", "mongodb://localhost:27017")
     MONGODB_DB: str = os.getenv("MONGODB_DB", "cyberintelx")
     
+    # Redis (optional backplane for WebSocket broadcasts across workers)
+    REDIS_URL: str = os.getenv("REDIS_URL", "")
+    
     # API Keys
     VIRUSTOTAL_API_KEY: str = os.getenv("VIRUSTOTAL_API_KEY", "")
     OTX_API_KEY: str = os.getenv("OTX_API_KEY", "")
@@ -38,6 +41,14 @@ class Settings(BaseSettings):
     DEBUG: bool = os.getenv("DEBUG", "False").lower() == "true"
     WORKERS: int = int(os.getenv("WORKERS", "1"))
     
+    # Provider rate limits
+    VIRUSTOTAL_REQUESTS_PER_MINUTE: int = int(os.getenv("VIRUSTOTAL_REQUESTS_PER_MINUTE", "4"))
+    NVD_REQUESTS_PER_MINUTE: int = int(os.getenv("NVD_REQUESTS_PER_MINUTE", "10"))
+    INGESTION_MAX_CONCURRENT: int = int(os.getenv("INGESTION_MAX_CONCURRENT", "64"))
+    
+    # Look up missing IP geolocation during correlation (uses ipstack quota)
+    CORRELATION_GEO_BACKFILL: bool = os.getenv("CORRELATION_GEO_BACKFILL", "False").lower() == "true"
+    
     # Ingestion intervals
     NVD_INGESTION_INTERVAL: int = int(os.getenv("NVD_INGESTION_INTERVAL", "3600"))
     VIRUSTOTAL_INGESTION_INTERVAL: int = int(os.getenv("VIRUSTOTAL_INGESTION_INTERVAL", "3600"))
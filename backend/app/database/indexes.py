@@ -21,6 +21,9 @@ async def create_indexes():
     correlations_collection = db["correlations"]
     await _create_correlation_indexes(correlations_collection)
     
+    # Indexes for the correlation service queries
+    await _create_correlation_query_indexes(threats_collection, correlations_collection)
+    
     # Indexes for the users collection
     users_collection = db["users"]
     await _create_user_indexes(users_collection)
@@ -32,6 +35,78 @@ async def create_indexes():
     logger.info("Database indexes have been created/verified")
 
 
+async def create_alert_text_index():
+    """Create the text index backing the alert list search"""
+    from app.database.db import Database
+    
+    db = await Database.get_database()
+    await _create_alert_text_index(db["alerts"])
+
+
+async def create_correlation_query_indexes():
+    """Create the indexes backing the correlation service queries"""
+    from app.database.db import Database
+    
+    db = await Database.get_database()
+    await _create_correlation_query_indexes(db["threats"], db["correlations"])
+
+
+async def _create_correlation_query_indexes(
+    threats: AsyncIOMotorCollection,
+    correlations: AsyncIOMotorCollection
+):
+    """Create the indexes for the correlation service queries"""
+    # Index for the (type, value) lookups when saving and loading threats
+    await _try_create_index(threats, "value", unique=True, name="value_unique")
+    
+    # Index for geographic queries within a time window
+    await _try_create_index(threats, [
+        ("geo.country", 1),
+        ("geo.city", 1),
+        ("last_seen", -1)
+    ], name="geo_timestamp")
+    
+    # Index for finding threats changed since the last correlation run
+    await _try_create_index(threats, [("updated_at", -1)], name="updated_at")
+    
+    # Indexes for the time window scan and the grouping aggregation
+    await _try_create_index(threats, [
+        ("last_seen", -1),
+        ("mitre_attack", 1)
+    ], name="timestamp_mitre_attack")
+    await _try_create_index(threats, [
+        ("last_seen", -1),
+        ("geo.country", 1),
+        ("geo.city", 1)
+    ], name="timestamp_geo")
+    
+    # Index for finding an existing correlation by type and member threats
+    await _try_create_index(correlations, [
+        ("type", 1),
+        ("threats", 1)
+    ], name="type_threats")
+
+
+async def _try_create_index(collection: AsyncIOMotorCollection, keys, **kwargs):
+    """Create an index, logging rather than raising if it can't be built"""
+    try:
+        await collection.create_index(keys, **kwargs)
+    except Exception as e:
+        logger.warning(f"Could not create index {kwargs.get('name')} on {collection.name}: {e}")
+
+
+async def _create_alert_text_index(collection: AsyncIOMotorCollection):
+    """Create the text index for the alerts collection"""
+    try:
+        await collection.create_index(
+            [("title", "text"), ("description", "text"), ("source", "text")],
+            name="text_search",
+            default_language="english"
+        )
+    except Exception as e:
+        logger.warning(f"Could not create text index for alerts: {e}")
+
+
 async def _create_threat_indexes(collection: AsyncIOMotorCollection):
     """Create indexes for the threats collection"""
     # Compound index for common queries
@@ -41,9 +116,6 @@ async def _create_threat_indexes(collection: AsyncIOMotorCollection):
         ("last_seen", -1)
     ], name="type_severity_timestamp")
     
-    # Index for value lookups
-    await collection.create_index("value", unique=True, name="value_unique")
-    
     # Index for source and last_seen
     await collection.create_index([
         ("source", 1),
@@ -136,6 +208,9 @@ async def _create_alert_indexes(collection: AsyncIOMotorCollection):
     # Index for related threats
     await collection.create_index("related_threats", name="related_threats")
     
+    # Text index backing the alert list search
+    await _create_alert_text_index(collection)
+    
     # TTL index for auto-deleting old resolved alerts (90 days)
     try:
         await collection.create_index(
@@ -0,0 +1,176 @@
+import asyncio
+import random
+import time
+from collections import deque
+from typing import Any, AsyncContextManager, Callable, Deque, Dict, Mapping, Optional
+
+import aiohttp
+from yarl import URL
+
+from app.app_logging import logger
+
+class SlidingWindowLimiter:
+    """Per-host request limiter shared by all ingestors
+
+    Hosts with a known quota are limited proactively to that many requests
+    per window. Any host can also be paused reactively from the rate-limit
+    headers of its responses.
+    """
+
+    def __init__(self, limits: Optional[Dict[str, int]] = None, period: float = 60.0):
+        self.limits = dict(limits or {})
+        self.period = period
+        self._windows: Dict[str, Deque[float]] = {}
+        self._blocked_until: Dict[str, float] = {}
+
+    async def wait_if_throttled(self, host: str):
+        """Wait until a request to the host fits within its limits"""
+        # Respect any pause requested by the provider first
+        delay = self._blocked_until.get(host, 0) - time.monotonic()
+        if delay > 0:
+            logger.debug(f"Waiting {delay:.2f}s for {host} rate limit to reset")
+            await asyncio.sleep(delay)
+
+        limit = self.limits.get(host)
+        if not limit:
+            return
+
+        window = self._windows.setdefault(host, deque())
+        while True:
+            now = time.monotonic()
+            while window and window[0] <= now - self.period:
+                window.popleft()
+            if len(window) < limit:
+                window.append(now)
+                return
+            await asyncio.sleep(window[0] + self.period - now)
+
+    def blocked_for(self, host: str) -> float:
+        """Return how many seconds requests to the host are still paused for"""
+        return max(0.0, self._blocked_until.get(host, 0) - time.monotonic())
+
+    def update_from_headers(self, host: str, headers: Mapping[str, str]):
+        """Pause the host if its response says the quota is exhausted"""
+        delay = self._retry_after(headers)
+        if delay is None and headers.get("x-ratelimit-remaining") == "0":
+            delay = self._reset_delay(headers.get("x-ratelimit-reset"))
+        if not delay or delay <= 0:
+            return
+
+        blocked_until = time.monotonic() + delay
+        if blocked_until > self._blocked_until.get(host, 0):
+            self._blocked_until[host] = blocked_until
+            logger.warning(f"Rate limit reached for {host}, pausing requests for {delay:.2f}s")
+
+    @staticmethod
+    def _retry_after(headers: Mapping[str, str]) -> Optional[float]:
+        """Parse a Retry-After header given in seconds"""
+        try:
+            return float(headers["retry-after"])
+        except (KeyError, ValueError):
+            return None
+
+    @staticmethod
+    def _reset_delay(value: Optional[str]) -> Optional[float]:
+        """Convert a rate-limit reset header to seconds from now"""
+        try:
+            reset = float(value)
+        except (TypeError, ValueError):
+            return None
+        # Providers send either an epoch timestamp or a delay in seconds
+        return reset - time.time() if reset > 1e9 else reset
+
+
+class RateLimitedSession:
+    """Client session wrapper that admits each request before sending it
+
+    Waiting for admission happens before the request is made, so time spent
+    queued for a rate limit doesn't count towards the request's timeout.
+    Idempotent requests answered with a throttling or overload status are
+    retried with jittered exponential backoff.
+    """
+
+    RETRY_STATUSES = {429, 502, 503, 504}
+    RETRY_METHODS = {"GET", "HEAD"}
+    RETRY_BASE = 2.0
+    RETRY_CAP = 120.0
+    MAX_RETRIES = 3
+
+    def __init__(
+        self,
+        session: aiohttp.ClientSession,
+        admit: Callable[[str], AsyncContextManager[None]],
+        observe: Callable[[str, aiohttp.ClientResponse], None]
+    ):
+        self._session = session
+        self._admit = admit
+        self._observe = observe
+
+    @property
+    def closed(self) -> bool:
+        return self._session.closed
+
+    async def close(self):
+        await self._session.close()
+
+    def request(self, method: str, url: str, **kwargs) -> "_LimitedRequest":
+        """Make a request once it is admitted; use as an async context manager"""
+        return _LimitedRequest(self, method, url, kwargs)
+
+    def get(self, url: str, **kwargs) -> "_LimitedRequest":
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> "_LimitedRequest":
+        return self.request("POST", url, **kwargs)
+
+
+class _LimitedRequest:
+    """A request that holds its admission until the response is released"""
+
+    def __init__(self, owner: RateLimitedSession, method: str, url: str, kwargs: Dict[str, Any]):
+        self._owner = owner
+        self._method = method
+        self._url = url
+        self._kwargs = kwargs
+        self._admission: Optional[AsyncContextManager[None]] = None
+        self._request = None
+
+    async def __aenter__(self) -> aiohttp.ClientResponse:
+        owner = self._owner
+        host = URL(self._url).host
+        retries = owner.MAX_RETRIES if self._method.upper() in owner.RETRY_METHODS else 0
+        attempt = 0
+        while True:
+            response = await self._send(host)
+            if response.status not in owner.RETRY_STATUSES or attempt >= retries:
+                return response
+
+            # Release the failed attempt before backing off; a Retry-After
+            # is also honoured by the limiter when the request is admitted again
+            await self.__aexit__(None, None, None)
+            delay = min(owner.RETRY_CAP, owner.RETRY_BASE * 2 ** attempt) + random.random() * owner.RETRY_BASE
+            attempt += 1
+            logger.warning(
+                f"{self._method} {host} returned {response.status}, "
+                f"retrying in {delay:.2f}s (attempt {attempt}/{retries})"
+            )
+            await asyncio.sleep(delay)
+
+    async def _send(self, host: str) -> aiohttp.ClientResponse:
+        """Send one attempt of the request once it is admitted"""
+        self._admission = self._owner._admit(host)
+        await self._admission.__aenter__()
+        try:
+            self._request = self._owner._session.request(self._method, self._url, **self._kwargs)
+            response = await self._request.__aenter__()
+        except BaseException as e:
+            await self._admission.__aexit__(type(e), e, e.__traceback__)
+            raise
+        self._owner._observe(host, response)
+        return response
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        try:
+            await self._request.__aexit__(exc_type, exc_val, exc_tb)
+        finally:
+            await self._admission.__aexit__(exc_type, exc_val, exc_tb)
@@ -108,47 +108,54 @@ class VirusTotalIngestor(BaseIngestor):
             if not endpoint:
                 return threat
             
-            async with self.session.get(
+            data = await self._get_json(
                 f"{self.base_url}/{endpoint}",
-                headers=self.headers,
                 timeout=aiohttp.ClientTimeout(total=60)
-            ) as response:
-                if response.status != 200:
-                    return threat
-                
-                data = await response.json()
-                attributes = data.get("data", {}).get("attributes", {})
-                
-                # Update enrichment data
-                enrichment = threat.enrichment or {}
-                enrichment["last_analysis_stats"] = attributes.get("last_analysis_stats", {})
-                enrichment["reputation"] = attributes.get("reputation", 0)
-                
-                # Add tags based on detections
-                tags = set(threat.tags or [])
-                if "last_analysis_results" in attributes:
-                    for result in attributes["last_analysis_results"].values():
-                        if result.get("category") == "malicious" and "result" in result:
-                            tags.add(f"vt:{result['result']}")
-                
-                # Add MITRE ATT&CK techniques if available
-                mitre_attack = set(threat.mitre_attack or [])
-                if "crowdsourced_yara_results" in attributes:
-                    for yara in attributes["crowdsourced_yara_results"]:
-                        if "meta" in yara and "mitre_attack" in yara["meta"]:
-                            mitre_attack.update(yara["meta"]["mitre_attack"].split(","))
-                
-                # Update the threat with enriched data
-                threat.enrichment = enrichment
-                threat.tags = list(tags)
-                threat.mitre_attack = list(mitre_attack)
-                
+            )
+            if data is None:
                 return threat
-                
+            
+            attributes = data.get("data", {}).get("attributes", {})
+            
+            # Update enrichment data
+            enrichment = threat.enrichment or {}
+            enrichment["last_analysis_stats"] = attributes.get("last_analysis_stats", {})
+            enrichment["reputation"] = attributes.get("reputation", 0)
+            
+            # Add tags based on detections
+            tags = set(threat.tags or [])
+            if "last_analysis_results" in attributes:
+                for result in attributes["last_analysis_results"].values():
+                    if result.get("category") == "malicious" and "result" in result:
+                        tags.add(f"vt:{result['result']}")
+            
+            # Add MITRE ATT&CK techniques if available
+            mitre_attack = set(threat.mitre_attack or [])
+            if "crowdsourced_yara_results" in attributes:
+                for yara in attributes["crowdsourced_yara_results"]:
+                    if "meta" in yara and "mitre_attack" in yara["meta"]:
+                        mitre_attack.update(yara["meta"]["mitre_attack"].split(","))
+            
+            # Update the threat with enriched data
+            threat.enrichment = enrichment
+            threat.tags = list(tags)
+            threat.mitre_attack = list(mitre_attack)
+            
+            return threat
+            
         except Exception as e:
             logger.error(f"Error enriching threat {threat.value}: {e}")
             return threat
     
+    async def _get_json(self, url: str, **kwargs) -> Optional[Dict[str, Any]]:
+        """GET a VirusTotal endpoint, returning None unless it succeeds"""
+        # Rate limiting and retrying on HTTP 429 are handled by the
+        # manager's shared session
+        async with self.session.get(url, headers=self.headers, **kwargs) as response:
+            if response.status == 200:
+                return await response.json()
+            return None
+    
     async def parse(self, data: Dict[str, Any]) -> List[ThreatIntel]:
         """Parse VirusTotal data into ThreatIntel objects"""
         try:
@@ -1,22 +1,29 @@
 import asyncio
 import os
+import re
 import signal
-import json
 from datetime import datetime
 from contextlib import asynccontextmanager
 from typing import List, Dict, Any, Optional
  
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Depends, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, Response
+from fastapi.responses import JSONResponse, ORJSONResponse, Response
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from pydantic import BaseModel
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, OperationFailure
+import orjson
 import uvicorn
 
 from .database.db import Database, get_database
+from .database.indexes import create_alert_text_index
 from .database.models import ThreatIntel, ThreatInDB, ThreatType, Severity, ThreatSource, Alert, User, Token, TokenData
 from .services.ingest_service import ingestion_manager, start_ingestion, stop_ingestion, get_ingestion_status
 from .services.correlation_service import correlation_service, start_correlation, stop_correlation, get_correlation_status
+from .services.geolocation import close_geolocation_session
+from .services.redis_relay import RedisRelay
 from .app_logging import logger, get_logger
 from .config import settings
 
@@ -28,8 +35,29 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/auth/token")
 
 # WebSocket manager
 class ConnectionManager:
-    def __init__(self):
+    # Redis channel that carries broadcasts between workers
+    BROADCAST_CHANNEL = "live:broadcast"
+
+    def __init__(self, send_timeout: float = 1.0, redis_url: str = settings.REDIS_URL):
         self.active_connections: List[WebSocket] = []
+        self.send_timeout = send_timeout
+        self._relay: Optional[RedisRelay] = (
+            RedisRelay(redis_url, self.BROADCAST_CHANNEL, self._relay_broadcast) if redis_url else None
+        )
+
+    async def start(self):
+        """Start relaying broadcasts published by other workers"""
+        if self._relay is not None:
+            await self._relay.start()
+
+    async def stop(self):
+        """Stop relaying broadcasts"""
+        if self._relay is not None:
+            await self._relay.stop()
+
+    async def _relay_broadcast(self, channel: str, message: str):
+        """Relay a broadcast published by any worker to this worker's clients"""
+        await self._local_broadcast(message)
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
@@ -41,18 +69,111 @@ class ConnectionManager:
             self.active_connections.remove(websocket)
             logger.info(f"WebSocket disconnected. Total connections: {len(self.active_connections)}")
 
+    async def _send(self, connection: WebSocket, message: str) -> Optional[WebSocket]:
+        """Send to one client, returning the connection if it failed or stalled"""
+        try:
+            await asyncio.wait_for(connection.send_text(message), timeout=self.send_timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Dropping slow WebSocket client")
+            return connection
+        except Exception as e:
+            logger.error(f"Error sending WebSocket message: {e}")
+            return connection
+        return None
+
     async def broadcast(self, message: str):
-        """Send a message to all connected clients"""
-        for connection in self.active_connections:
+        """Send a message to all connected clients
+        
+        With a Redis backplane the message reaches clients on every worker.
+        """
+        if self._relay is not None and self._relay.running:
             try:
-                await connection.send_text(message)
+                await self._relay.publish(self.BROADCAST_CHANNEL, message)
+                return
             except Exception as e:
-                logger.error(f"Error sending WebSocket message: {e}")
-                self.disconnect(connection)
+                logger.error(f"Error publishing to Redis, broadcasting locally: {e}")
+        await self._local_broadcast(message)
+
+    async def _local_broadcast(self, message: str):
+        """Send a message to this worker's connected clients"""
+        # Sends run concurrently with a per-client timeout so one slow peer
+        # cannot hold up delivery to everyone else
+        results = await asyncio.gather(*(self._send(c, message) for c in list(self.active_connections)))
+        for connection in results:
+            if connection is None:
+                continue
+            self.disconnect(connection)
+            try:
+                await connection.close()
+            except Exception:
+                pass
 
 # Global WebSocket manager
 manager = ConnectionManager()
 
+# Webhook threats are buffered and inserted in batches to cut Mongo
+# round-trips under bursty load
+WEBHOOK_BATCH_SIZE = 100
+WEBHOOK_BATCH_WINDOW = 0.05  # seconds
+WEBHOOK_DRAIN_TIMEOUT = 10.0  # seconds
+webhook_queue: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue()
+webhook_accepting = True
+
+async def _webhook_batch_writer():
+    """Drain the webhook queue, bulk-inserting each batch"""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await webhook_queue.get()]
+        deadline = loop.time() + WEBHOOK_BATCH_WINDOW
+        while len(batch) < WEBHOOK_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(webhook_queue.get(), timeout=timeout))
+            except asyncio.TimeoutError:
+                break
+        
+        try:
+            await _flush_webhook_batch(batch)
+        finally:
+            for _ in batch:
+                webhook_queue.task_done()
+
+async def _flush_webhook_batch(batch: List[Dict[str, Any]]):
+    """Bulk-insert a batch of webhook threats and broadcast the inserted ones"""
+    try:
+        await Database.get_collection("threats").insert_many(batch, ordered=False)
+    except BulkWriteError as e:
+        failed = {err["index"] for err in e.details.get("writeErrors", [])}
+        logger.error(f"Failed to insert {len(failed)} of {len(batch)} webhook threats")
+        batch = [doc for i, doc in enumerate(batch) if i not in failed]
+    except Exception as e:
+        logger.error(f"Error inserting webhook threats: {e}", exc_info=True)
+        return
+    
+    # Clients expect one "threat" message per created threat
+    for doc in batch:
+        await manager.broadcast(orjson.dumps({
+            "type": "threat",
+            "action": "created",
+            "data": {"id": str(doc["_id"]), "value": doc["value"], "type": doc["type"]}
+        }).decode())
+
+async def _stop_webhook_writer(webhook_writer: "asyncio.Task[None]"):
+    """Stop accepting webhook threats and flush the queued ones before stopping the writer"""
+    global webhook_accepting
+    webhook_accepting = False
+    try:
+        await asyncio.wait_for(webhook_queue.join(), timeout=WEBHOOK_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.error(f"Timed out flushing webhook threats, {webhook_queue.qsize()} not saved")
+    webhook_writer.cancel()
+    try:
+        await webhook_writer
+    except asyncio.CancelledError:
+        pass
+
 # Lifespan events
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -63,17 +184,27 @@ async def lifespan(app: FastAPI):
     await Database.connect_db()
     logger.info("Database connection established")
     
+    # Index backing the alert search
+    await create_alert_text_index()
+    
+    # Relay WebSocket broadcasts between workers
+    await manager.start()
+    
     # Start background tasks
     asyncio.create_task(start_ingestion())
     asyncio.create_task(start_correlation())
+    webhook_writer = asyncio.create_task(_webhook_batch_writer())
     logger.info("Background services started")
     
     yield  # App is running
     
     # Shutdown
     logger.info("Shutting down CyberIntel-X backend...")
+    await _stop_webhook_writer(webhook_writer)
+    await manager.stop()
     await stop_ingestion()
     await stop_correlation()
+    await close_geolocation_session()
     await Database.close_db()
     logger.info("Shutdown complete")
 
@@ -147,8 +278,7 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
 async def websocket_endpoint(websocket: WebSocket):
     """WebSocket endpoint for real-time threat updates"""
     # Check for authorization token in query parameters
-    query_params = dict(websocket.query_params)
-    token = query_params.get("token")
+    token = websocket.query_params.get("token")
     
     # For now, we'll accept all connections (in production, validate the token)
     # You can implement proper token validation here
@@ -189,8 +319,9 @@ async def get_threats(
     if source:
         query["source"] = source
     
+    # Raw documents are validated once by the response_model
     cursor = db["threats"].find(query).skip(skip).limit(limit)
-    return [ThreatInDB(**doc) async for doc in cursor]
+    return await cursor.to_list(length=limit)
 
 @app.get("/api/threats/{threat_id}", response_model=ThreatInDB)
 async def get_threat(threat_id: str, db=Depends(get_database)):
@@ -200,8 +331,14 @@ async def get_threat(threat_id: str, db=Depends(get_database)):
         raise HTTPException(status_code=404, detail="Threat not found")
     return ThreatInDB(**threat)
 
+def _stringify_id(doc: Dict[str, Any]) -> Dict[str, Any]:
+    """Make a document's _id JSON serializable in place"""
+    if "_id" in doc:
+        doc["_id"] = str(doc["_id"])
+    return doc
+
 # API endpoints for alerts (minimal stubs)
-@app.get("/api/alerts")
+@app.get("/api/alerts", response_model=None)
 async def get_alerts(
     page: int = 1,
     limit: int = 100,
@@ -215,14 +352,6 @@ async def get_alerts(
     skip = (page - 1) * limit
     query: Dict[str, Any] = {}
     
-    # Handle search parameter
-    if search:
-        query["$or"] = [
-            {"title": {"$regex": search, "$options": "i"}},
-            {"description": {"$regex": search, "$options": "i"}},
-            {"source": {"$regex": search, "$options": "i"}}
-        ]
-    
     if severity:
         query["severity"] = severity.value
     if status:
@@ -230,31 +359,35 @@ async def get_alerts(
     if source:
         query["source"] = source.value
         
-    cursor = db["alerts"].find(query).skip(skip).limit(limit)
-    results = []
-    async for doc in cursor:
-        if "_id" in doc:
-            doc["_id"] = str(doc["_id"])  # ensure serializable
-        results.append(Alert(**doc))
+    async def _fetch_page(query: Dict[str, Any]) -> List[Dict[str, Any]]:
+        cursor = db["alerts"].find(query).skip(skip).limit(limit)
+        return [_stringify_id(doc) for doc in await cursor.to_list(length=limit)]
     
-    # Get total count for pagination
-    total_count = await db["alerts"].count_documents(query)
+    async def _fetch(query: Dict[str, Any]):
+        # Fetch the page and the total count for pagination concurrently
+        return await asyncio.gather(
+            _fetch_page(query),
+            db["alerts"].count_documents(query)
+        )
     
-    return {"alerts": results, "totalCount": total_count}
-    query: Dict[str, Any] = {}
-    if severity:
-        query["severity"] = severity.value
-    if status:
-        query["status"] = status
-    if source:
-        query["source"] = source.value
-    cursor = db["alerts"].find(query).skip(skip).limit(limit)
-    results = []
-    async for doc in cursor:
-        if "_id" in doc:
-            doc["_id"] = str(doc["_id"])  # ensure serializable
-        results.append(Alert(**doc))
-    return results
+    # Handle search parameter (served by the alerts text index)
+    if search:
+        try:
+            results, total_count = await _fetch({**query, "$text": {"$search": search}})
+        except OperationFailure as e:
+            if e.code != 27:  # IndexNotFound
+                raise
+            # Without the text index fall back to a substring match
+            logger.warning("Alerts text index missing, falling back to regex search")
+            pattern = {"$regex": re.escape(search), "$options": "i"}
+            query["$or"] = [{"title": pattern}, {"description": pattern}, {"source": pattern}]
+            results, total_count = await _fetch(query)
+    else:
+        results, total_count = await _fetch(query)
+    
+    # Stored alerts already have the response shape, so skip model
+    # construction and serialize the documents directly
+    return ORJSONResponse({"alerts": results, "totalCount": total_count})
 
 @app.get("/api/alerts/{alert_id}", response_model=Alert)
 async def get_alert(alert_id: str, db=Depends(get_database)):
@@ -270,13 +403,14 @@ class StatusUpdate(BaseModel):
 
 @app.patch("/api/alerts/{alert_id}/status")
 async def update_alert_status(alert_id: str, body: StatusUpdate, db=Depends(get_database)):
-    result = await db["alerts"].update_one({"_id": alert_id}, {"$set": {"status": body.status, "updated_at": datetime.utcnow()}})
-    if result.matched_count == 0:
+    updated = await db["alerts"].find_one_and_update(
+        {"_id": alert_id},
+        {"$set": {"status": body.status, "updated_at": datetime.utcnow()}},
+        return_document=ReturnDocument.AFTER
+    )
+    if updated is None:
         raise HTTPException(status_code=404, detail="Alert not found")
-    updated = await db["alerts"].find_one({"_id": alert_id})
-    if updated and "_id" in updated:
-        updated["_id"] = str(updated["_id"])
-    return updated or {"_id": alert_id, "status": body.status}
+    return _stringify_id(updated)
 
 @app.get("/api/alerts/stats")
 async def get_alert_stats(db=Depends(get_database)):
@@ -482,7 +616,7 @@ async def download_report_legacy(filename: str):
     return await download_report(report_id, format="pdf")
 
 # API endpoints for correlations
-@app.get("/api/correlations", response_model=List[Dict[str, Any]])
+@app.get("/api/correlations", response_model=None)
 async def get_correlations(
     skip: int = 0,
     limit: int = 100,
@@ -495,8 +629,10 @@ async def get_correlations(
     if correlation_type:
         query["type"] = correlation_type
     
+    # Correlation documents are dict-heavy, so serialize them with orjson
+    # rather than running them through FastAPI's encoder
     cursor = db["correlations"].find(query).sort("last_seen", -1).skip(skip).limit(limit)
-    return [doc async for doc in cursor]
+    return ORJSONResponse([_stringify_id(doc) for doc in await cursor.to_list(length=limit)])
 
 # API endpoints for system management
 @app.get("/api/system/status")
@@ -551,22 +687,22 @@ async def stop_correlation_service():
 @app.post("/api/webhook/threat")
 async def webhook_receive_threat(threat: ThreatIntel):
     """Webhook endpoint for receiving threat data from external sources"""
-    # Save the threat to the database
-    collection = Database.get_collection("threats")
+    if not webhook_accepting:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Server is shutting down"
+        )
+    
+    # Queue the threat for the batch writer; the id is assigned up front so it
+    # can be returned before the insert happens
     threat_doc = threat.dict()
+    threat_doc["_id"] = ObjectId()
     threat_doc["created_at"] = datetime.utcnow()
     threat_doc["updated_at"] = datetime.utcnow()
     
-    result = await collection.insert_one(threat_doc)
-    
-    # Notify WebSocket clients
-    await manager.broadcast(json.dumps({
-        "type": "threat",
-        "action": "created",
-        "data": {"id": str(result.inserted_id), "value": threat.value, "type": threat.type}
-    }))
+    webhook_queue.put_nowait(threat_doc)
     
-    return {"status": "received", "id": str(result.inserted_id)}
+    return {"status": "received", "id": str(threat_doc["_id"])}
 
 # Error handlers
 @app.exception_handler(HTTPException)
@@ -1,30 +1,117 @@
 import asyncio
+from dataclasses import dataclass, fields
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Set, Tuple, Any, Callable, Awaitable
-from collections import defaultdict
-import json
+from collections import Counter, defaultdict
 import logging
 
-from app.database.models import ThreatIntel, ThreatInDB, ThreatType, Severity, GeoLocation
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
+
+from app.database.models import ThreatIntel, ThreatInDB, ThreatType, GeoLocation
 from app.database.db import Database
+from app.database.indexes import create_correlation_query_indexes
+from app.services.geolocation import get_geolocations_bulk
 from app.app_logging import logger
 from app.config import settings
 
+# Severity ranks used when combining severities; values are the lowercase
+# Severity enum values
+_SEVERITY_ORDER = {"info": 0, "low": 1, "medium": 2, "high": 3, "critical": 4}
+_SEVERITY_LEVELS = sorted(_SEVERITY_ORDER, key=_SEVERITY_ORDER.get)
+
+# Enrichment paths that may hold domains/URLs related to a hash
+_HASH_DOMAIN_PATHS = [
+    ("domains",), ("hosts",), ("urls",), ("download_urls",),
+    ("metadata", "domain"), ("metadata", "host"), ("metadata", "url")
+]
+
+# Enrichment paths that may hold IPs a domain resolves to
+_DOMAIN_IP_PATHS = [
+    ("ips",), ("resolved_ips",), ("a_records",),
+    ("metadata", "ip"), ("metadata", "resolved_ip")
+]
+
+def _extract(enrichment: Dict[str, Any], paths: List[Tuple[str, ...]]) -> Set[str]:
+    """Collect the values found at the given paths of an enrichment dict"""
+    values = set()
+    for path in paths:
+        value = enrichment
+        for key in path:
+            value = value.get(key) if isinstance(value, dict) else None
+        if not value:
+            continue
+        if isinstance(value, list):
+            values.update(value)
+        else:
+            values.add(value)
+    return values
+
+@dataclass(slots=True)
+class _ThreatView:
+    """Lightweight view of a stored threat used during correlation"""
+    id: str
+    type: str
+    value: str
+    first_seen: datetime
+    last_seen: datetime
+    severity: str
+    confidence: float
+    source: str
+    enrichment: Optional[Dict[str, Any]]
+    geo: Optional[Dict[str, Any]]
+
+_THREAT_VIEW_FIELDS = tuple(f.name for f in fields(_ThreatView) if f.name != "id")
+
+def _threat_view(doc: Dict[str, Any]) -> _ThreatView:
+    """Build a threat view from a projected threat document"""
+    return _ThreatView(str(doc["_id"]), *(doc.get(name) for name in _THREAT_VIEW_FIELDS))
+
 class CorrelationService:
     """Service for correlating threat intelligence data"""
     
+    # Per-group accumulators shared by the aggregation-based correlations
+    _GROUP_ACCUMULATORS = {
+        "threat_ids": {"$push": {"$toString": "$_id"}},
+        "count": {"$sum": 1},
+        "avg_conf": {"$avg": {"$ifNull": ["$confidence", 0.5]}},
+        "first_seen": {"$min": "$first_seen"},
+        "last_seen": {"$max": "$last_seen"},
+        "sources": {"$addToSet": "$source"},
+        "severities": {"$addToSet": "$severity"}
+    }
+    
+    # Threat fields read by the in-memory correlations
+    _THREAT_PROJECTION = {
+        "type": 1,
+        "value": 1,
+        "enrichment": 1,
+        "first_seen": 1,
+        "last_seen": 1,
+        "severity": 1,
+        "confidence": 1,
+        "source": 1,
+        "geo": 1
+    }
+    
     def __init__(self):
         self.logger = logging.getLogger(__name__)
         self.is_running = False
         self._shutdown = False
         self.correlation_interval = getattr(settings, "CORRELATION_INTERVAL", 300)  # 5 minutes by default
         self.min_confidence = getattr(settings, "MIN_CORRELATION_CONFIDENCE", 0.7)
+        self.scan_batch_size = getattr(settings, "CORRELATION_SCAN_BATCH_SIZE", 5000)
+        self.full_scan_interval = getattr(settings, "CORRELATION_FULL_SCAN_INTERVAL", 3600)  # 1 hour by default
+        self.geo_backfill = getattr(settings, "CORRELATION_GEO_BACKFILL", False)
         self.correlations = {}
         self.last_run = None
+        self._watermark: Optional[datetime] = None
+        self._last_full_scan: Optional[datetime] = None
     
     async def initialize(self):
         """Initialize the correlation service"""
         # Note: We rely on the main app to manage database connections
+        await create_correlation_query_indexes()
         self.logger.info("Correlation service initialized")
     
     async def shutdown(self):
@@ -37,66 +124,110 @@ class CorrelationService:
     async def correlate_threats(self, time_window_hours: int = 24):
         """Correlate threats from the database"""
         try:
-            start_time = datetime.utcnow() - timedelta(hours=time_window_hours)
+            run_started = datetime.utcnow()
+            start_time = run_started - timedelta(hours=time_window_hours)
             
-            # Get all threats from the database within the time window
-            collection = Database.get_collection("threats")
-            cursor = collection.find({
-                "last_seen": {"$gte": start_time}
-            })
-            
-            threats = []
-            async for doc in cursor:
-                # Convert MongoDB document to ThreatIntel object
-                threats.append(ThreatInDB(**doc))
+            # Between periodic full scans only threats written since the
+            # previous run are loaded. A full scan also picks up pairs where
+            # only the counterpart (e.g. a CVE or domain) is new.
+            full_scan = (
+                self._watermark is None
+                or self._last_full_scan is None
+                or (run_started - self._last_full_scan).total_seconds() >= self.full_scan_interval
+            )
+            query = {"last_seen": {"$gte": start_time}}
+            if not full_scan:
+                query["updated_at"] = {"$gte": self._watermark}
             
-            self.logger.info(f"Correlating {len(threats)} threats from the last {time_window_hours} hours")
+            # Get the threats from the database within the time window,
+            # fetching only the fields the in-memory correlations read
+            collection = Database.get_collection("threats")
+            cursor = collection.find(
+                query,
+                projection=self._THREAT_PROJECTION
+            ).batch_size(self.scan_batch_size)
             
-            # Group threats by type
+            # Group threats by type and build the value lookups used by the
+            # correlations in a single pass over the cursor
+            threat_count = 0
             threats_by_type = defaultdict(list)
-            for threat in threats:
+            ip_map = {}
+            domain_map = {}
+            cve_map = {}
+            ips_without_geo = []
+            for doc in await cursor.to_list(length=None):
+                # Stored documents were validated on write, so they are read
+                # into plain views rather than re-validated models
+                threat = _threat_view(doc)
+                threat_count += 1
                 threats_by_type[threat.type].append(threat)
+                
+                if threat.type == ThreatType.IP:
+                    ip_map[threat.value] = threat
+                    if self.geo_backfill and not threat.geo:
+                        ips_without_geo.append(threat)
+                elif threat.type in (ThreatType.DOMAIN, ThreatType.URL):
+                    domain_map[threat.value.lower()] = threat
+                elif threat.type == ThreatType.CVE:
+                    cve_map.setdefault(threat.value.upper(), threat)
             
-            # Find correlations between different types of threats
-            correlations = []
+            self.logger.info(
+                f"Correlating {threat_count} threats from the last {time_window_hours} hours"
+                f" ({'full scan' if full_scan else 'changed since last run'})"
+            )
+            
+            # Changed IPs may reference CVEs that weren't loaded
+            if not full_scan:
+                await self._load_referenced_cves(threats_by_type.get(ThreatType.IP, []), cve_map)
+            
+            # Find correlations between different types of threats. The
+            # stages read separate slices of the scan and only extend the
+            # lookup maps they own, so their database I/O can overlap.
+            stages = []
             
             # 1. Correlate IPs with CVEs (exploited vulnerabilities)
-            if ThreatType.IP in threats_by_type and ThreatType.CVE in threats_by_type:
-                ip_cve_correlations = await self._correlate_ips_with_cves(
+            if ThreatType.IP in threats_by_type and cve_map:
+                stages.append(self._correlate_ips_with_cves(
                     threats_by_type[ThreatType.IP],
-                    threats_by_type[ThreatType.CVE]
-                )
-                correlations.extend(ip_cve_correlations)
+                    cve_map
+                ))
             
-            # 2. Correlate hashes with domains/URLs (malware distribution)
-            if ThreatType.HASH in threats_by_type and (ThreatType.DOMAIN in threats_by_type or ThreatType.URL in threats_by_type):
-                hash_domain_correlations = await self._correlate_hashes_with_domains(
+            # 2. Correlate hashes with domains/URLs (malware distribution);
+            # domains missing from the scan are loaded or inferred by the stage
+            if ThreatType.HASH in threats_by_type:
+                stages.append(self._correlate_hashes_with_domains(
                     threats_by_type[ThreatType.HASH],
-                    threats_by_type.get(ThreatType.DOMAIN, []) + threats_by_type.get(ThreatType.URL, [])
-                )
-                correlations.extend(hash_domain_correlations)
+                    domain_map
+                ))
             
-            # 3. Correlate IPs with domains (C2 infrastructure)
-            if ThreatType.IP in threats_by_type and ThreatType.DOMAIN in threats_by_type:
-                ip_domain_correlations = await self._correlate_ips_with_domains(
-                    threats_by_type[ThreatType.IP],
+            # 3. Correlate IPs with domains (C2 infrastructure); IPs missing
+            # from the scan are loaded or inferred by the stage
+            if ThreatType.DOMAIN in threats_by_type:
+                stages.append(self._correlate_ips_with_domains(
+                    ip_map,
                     threats_by_type[ThreatType.DOMAIN]
-                )
-                correlations.extend(ip_domain_correlations)
+                ))
             
-            # 4. Correlate threats by MITRE ATT&CK techniques
-            mitre_correlations = await self._correlate_by_mitre_techniques(threats)
-            correlations.extend(mitre_correlations)
+            # 4-5. Correlate threats by MITRE ATT&CK techniques and geolocation
+            stages.append(self._correlate_groups(start_time, ips_without_geo, full_scan or threat_count > 0))
             
-            # 5. Correlate threats by geolocation
-            geo_correlations = await self._correlate_by_geolocation(threats)
-            correlations.extend(geo_correlations)
+            # A failing stage is logged without discarding the others
+            correlations = []
+            for result in await asyncio.gather(*stages, return_exceptions=True):
+                if isinstance(result, Exception):
+                    self.logger.error(f"Correlation stage failed: {result}", exc_info=result)
+                    continue
+                correlations.extend(result)
             
             # Save correlations to the database
             if correlations:
                 await self._save_correlations(correlations)
             
             self.last_run = datetime.utcnow()
+            # Overlap the next delta slightly to allow for out-of-order writes
+            self._watermark = run_started - timedelta(seconds=60)
+            if full_scan:
+                self._last_full_scan = run_started
             self.logger.info(f"Found {len(correlations)} correlations")
             
             return correlations
@@ -105,8 +236,11 @@ class CorrelationService:
             self.logger.error(f"Error in correlation service: {e}", exc_info=True)
             return []
     
-    async def _correlate_ips_with_cves(self, ip_threats: List[ThreatInDB], cve_threats: List[ThreatInDB]) -> List[Dict]:
-        """Correlate IPs with CVEs based on exploitation attempts"""
+    async def _correlate_ips_with_cves(self, ip_threats: List[_ThreatView], cve_map: Dict[str, _ThreatView]) -> List[Dict]:
+        """Correlate IPs with CVEs based on exploitation attempts
+        
+        cve_map maps uppercased CVE IDs to their threats.
+        """
         correlations = []
         
         for ip_threat in ip_threats:
@@ -116,7 +250,7 @@ class CorrelationService:
                 
             for cve_id in ip_threat.enrichment["cves"]:
                 # Find the corresponding CVE threat
-                cve_threat = next((c for c in cve_threats if c.value.upper() == cve_id.upper()), None)
+                cve_threat = cve_map.get(cve_id.upper())
                 if not cve_threat:
                     continue
                 
@@ -142,51 +276,62 @@ class CorrelationService:
         
         return correlations
     
-    async def _correlate_hashes_with_domains(self, hash_threats: List[ThreatInDB], domain_threats: List[ThreatInDB]) -> List[Dict]:
-        """Correlate malware hashes with domains/URLs where they were seen"""
-        correlations = []
+    async def _correlate_hashes_with_domains(self, hash_threats: List[_ThreatView], domain_map: Dict[str, _ThreatView]) -> List[Dict]:
+        """Correlate malware hashes with domains/URLs where they were seen
         
-        # Build a mapping of domains to their threats
-        domain_map = {t.value.lower(): t for t in domain_threats}
+        domain_map maps lowercased domain/URL values to their threats and is
+        extended with any domains inferred here.
+        """
+        correlations = []
         
+        # First pass: collect the domains referenced by each hash
+        hash_domains = []
         for hash_threat in hash_threats:
             if not hash_threat.enrichment:
                 continue
                 
-            # Check for domains in the enrichment data
-            domains = []
-            
-            # Check common fields where domains might be stored
-            for field in ["domains", "hosts", "urls", "download_urls"]:
-                if field in hash_threat.enrichment and hash_threat.enrichment[field]:
-                    domains.extend(hash_threat.enrichment[field])
-            
-            # Also check metadata
-            if "metadata" in hash_threat.enrichment:
-                for field in ["domain", "host", "url"]:
-                    if field in hash_threat.enrichment["metadata"] and hash_threat.enrichment["metadata"][field]:
-                        domains.append(hash_threat.enrichment["metadata"][field])
-            
-            # Process each domain
-            for domain in set(domains):
+            # Check the enrichment data for domains
+            domains = _extract(hash_threat.enrichment, _HASH_DOMAIN_PATHS)
+            hash_domains.append((hash_threat, domains))
+        
+        # Stored domains outside the scan are looked up so that only
+        # domains we don't know about yet are inferred
+        await self._load_referenced(
+            [ThreatType.DOMAIN, ThreatType.URL],
+            {domain for _, domains in hash_domains for domain in domains},
+            domain_map,
+            str.lower
+        )
+        
+        inferred = {}
+        for hash_threat, domains in hash_domains:
+            for domain in domains:
                 domain_lower = domain.lower()
-                domain_threat = domain_map.get(domain_lower)
+                if domain_lower in domain_map or domain_lower in inferred:
+                    continue
                 
+                # Create a new domain threat if it doesn't exist
+                inferred[domain_lower] = ThreatIntel(
+                    type=ThreatType.URL if "://" in domain_lower else ThreatType.DOMAIN,
+                    value=domain,
+                    first_seen=hash_threat.first_seen,
+                    last_seen=hash_threat.last_seen,
+                    severity=hash_threat.severity,
+                    source=hash_threat.source,
+                    confidence=hash_threat.confidence * 0.8,  # Slightly lower confidence for inferred domains
+                    tags=["inferred", "malware_distribution"]
+                )
+        
+        # Save all new domain threats in one batch
+        for domain_threat in await self._save_threats(list(inferred.values())):
+            domain_map[domain_threat.value.lower()] = domain_threat
+        
+        # Second pass: correlate each hash with its domains
+        for hash_threat, domains in hash_domains:
+            for domain in domains:
+                domain_threat = domain_map.get(domain.lower())
                 if not domain_threat:
-                    # Create a new domain threat if it doesn't exist
-                    domain_threat = ThreatIntel(
-                        type=ThreatType.URL if "://" in domain_lower else ThreatType.DOMAIN,
-                        value=domain,
-                        first_seen=hash_threat.first_seen,
-                        last_seen=hash_threat.last_seen,
-                        severity=hash_threat.severity,
-                        source=hash_threat.source,
-                        confidence=hash_threat.confidence * 0.8,  # Slightly lower confidence for inferred domains
-                        tags=["inferred", "malware_distribution"]
-                    )
-                    # Save the new domain threat
-                    domain_threat = await self._save_threat(domain_threat)
-                    domain_map[domain_lower] = domain_threat
+                    continue
                 
                 # Calculate confidence
                 confidence = self._calculate_confidence(hash_threat, domain_threat)
@@ -211,50 +356,61 @@ class CorrelationService:
         
         return correlations
     
-    async def _correlate_ips_with_domains(self, ip_threats: List[ThreatInDB], domain_threats: List[ThreatInDB]) -> List[Dict]:
-        """Correlate IPs with domains (e.g., C2 infrastructure)"""
-        correlations = []
+    async def _correlate_ips_with_domains(self, ip_map: Dict[str, _ThreatView], domain_threats: List[_ThreatView]) -> List[Dict]:
+        """Correlate IPs with domains (e.g., C2 infrastructure)
         
-        # Build a mapping of IPs to their threats
-        ip_map = {t.value: t for t in ip_threats}
+        ip_map maps IP values to their threats and is extended with any IPs
+        inferred here.
+        """
+        correlations = []
         
+        # First pass: collect the IPs referenced by each domain
+        domain_ips = []
         for domain_threat in domain_threats:
             if not domain_threat.enrichment:
                 continue
                 
-            # Check for IPs in the enrichment data
-            ips = []
-            
-            # Check common fields where IPs might be stored
-            for field in ["ips", "resolved_ips", "a_records"]:
-                if field in domain_threat.enrichment and domain_threat.enrichment[field]:
-                    ips.extend(domain_threat.enrichment[field])
-            
-            # Also check metadata
-            if "metadata" in domain_threat.enrichment:
-                for field in ["ip", "resolved_ip"]:
-                    if field in domain_threat.enrichment["metadata"] and domain_threat.enrichment["metadata"][field]:
-                        ips.append(domain_threat.enrichment["metadata"][field])
-            
-            # Process each IP
-            for ip in set(ips):
-                ip_threat = ip_map.get(ip)
+            # Check the enrichment data for IPs
+            ips = _extract(domain_threat.enrichment, _DOMAIN_IP_PATHS)
+            domain_ips.append((domain_threat, ips))
+        
+        # Stored IPs outside the scan are looked up so that only IPs we
+        # don't know about yet are inferred
+        await self._load_referenced(
+            [ThreatType.IP],
+            {ip for _, ips in domain_ips for ip in ips},
+            ip_map,
+            str
+        )
+        
+        inferred = {}
+        for domain_threat, ips in domain_ips:
+            for ip in ips:
+                if ip in ip_map or ip in inferred:
+                    continue
                 
+                # Create a new IP threat if it doesn't exist
+                inferred[ip] = ThreatIntel(
+                    type=ThreatType.IP,
+                    value=ip,
+                    first_seen=domain_threat.first_seen,
+                    last_seen=domain_threat.last_seen,
+                    severity=domain_threat.severity,
+                    source=domain_threat.source,
+                    confidence=domain_threat.confidence * 0.8,  # Slightly lower confidence for inferred IPs
+                    tags=["inferred", "infrastructure"]
+                )
+        
+        # Save all new IP threats in one batch
+        for ip_threat in await self._save_threats(list(inferred.values())):
+            ip_map[ip_threat.value] = ip_threat
+        
+        # Second pass: correlate each domain with its IPs
+        for domain_threat, ips in domain_ips:
+            for ip in ips:
+                ip_threat = ip_map.get(ip)
                 if not ip_threat:
-                    # Create a new IP threat if it doesn't exist
-                    ip_threat = ThreatIntel(
-                        type=ThreatType.IP,
-                        value=ip,
-                        first_seen=domain_threat.first_seen,
-                        last_seen=domain_threat.last_seen,
-                        severity=domain_threat.severity,
-                        source=domain_threat.source,
-                        confidence=domain_threat.confidence * 0.8,  # Slightly lower confidence for inferred IPs
-                        tags=["inferred", "infrastructure"]
-                    )
-                    # Save the new IP threat
-                    ip_threat = await self._save_threat(ip_threat)
-                    ip_map[ip] = ip_threat
+                    continue
                 
                 # Calculate confidence
                 confidence = self._calculate_confidence(ip_threat, domain_threat)
@@ -279,104 +435,275 @@ class CorrelationService:
         
         return correlations
     
-    async def _correlate_by_mitre_techniques(self, threats: List[ThreatInDB]) -> List[Dict]:
-        """Correlate threats by MITRE ATT&CK techniques"""
-        correlations = []
+    async def _correlate_groups(self, start_time: datetime, ips_without_geo: List[_ThreatView], changed: bool) -> List[Dict]:
+        """Correlate the time window by MITRE technique and by location"""
+        # Fill in missing IP geolocation before the geographic grouping runs;
+        # opt-in, since every lookup spends ipstack quota
+        if self.geo_backfill:
+            await self._backfill_geolocation(ips_without_geo)
+        
+        # Group the window by technique and location server-side. Groups
+        # need every member, so this always covers the full window, but
+        # it can be skipped when nothing changed since the last run.
+        if not changed:
+            return []
+        groups = await self._aggregate_groups(start_time)
+        
+        return (
+            self._correlate_by_mitre_techniques(groups["by_mitre"])
+            + self._correlate_by_geolocation(groups["by_geo"])
+        )
+    
+    def _grouping_query(self, start_time: datetime) -> Dict[str, Any]:
+        """Query for the threats in the window that can join a technique or location group"""
+        # Most hashes and CVEs carry neither, so they are dropped before
+        # grouping; each branch is served by its last_seen compound index,
+        # created in initialize()
+        return {
+            "last_seen": {"$gte": start_time},
+            "$or": [
+                {"mitre_attack": {"$exists": True, "$ne": []}},
+                {"geo.country": {"$exists": True, "$nin": [None, ""]}}
+            ]
+        }
+    
+    async def _aggregate_groups(self, start_time: datetime) -> Dict[str, List[Dict]]:
+        """Group the time window by MITRE technique and by location in one aggregation"""
+        # Keep only groups with multiple associated threats
+        group_filter = {"$match": {
+            "count": {"$gte": 2},
+            "avg_conf": {"$gte": self.min_confidence}
+        }}
+        
+        # A single $match feeds both group-bys, so the window is scanned once
+        collection = Database.get_collection("threats")
+        pipeline = [
+            {"$match": self._grouping_query(start_time)},
+            {"$facet": {
+                "by_mitre": [
+                    {"$match": {"mitre_attack": {"$exists": True, "$ne": []}}},
+                    {"$unwind": "$mitre_attack"},
+                    {"$group": {
+                        "_id": "$mitre_attack",
+                        **self._GROUP_ACCUMULATORS
+                    }},
+                    group_filter
+                ],
+                "by_geo": [
+                    {"$match": {"geo.country": {"$nin": [None, ""]}}},
+                    # Normalize the location once per threat and drop unused fields
+                    {"$project": {
+                        "country": {"$toUpper": "$geo.country"},
+                        # Missing and empty cities both group as "Unknown", as in the fallback
+                        "city": {"$cond": [
+                            {"$eq": [{"$ifNull": ["$geo.city", ""]}, ""]},
+                            "Unknown",
+                            "$geo.city"
+                        ]},
+                        "confidence": 1,
+                        "first_seen": 1,
+                        "last_seen": 1,
+                        "source": 1,
+                        "severity": 1
+                    }},
+                    {"$group": {
+                        "_id": {"country": "$country", "city": "$city"},
+                        **self._GROUP_ACCUMULATORS
+                    }},
+                    group_filter
+                ]
+            }}
+        ]
+        
+        try:
+            result = await collection.aggregate(pipeline).to_list(length=1)
+        except OperationFailure as e:
+            # e.g. the single $facet result document exceeding the BSON size limit
+            self.logger.warning(f"Group aggregation failed, grouping in memory instead: {e}")
+            return await self._group_in_memory(start_time)
+        return result[0] if result else {"by_mitre": [], "by_geo": []}
+    
+    async def _group_in_memory(self, start_time: datetime) -> Dict[str, List[Dict]]:
+        """Group the time window by MITRE technique and by location in Python"""
+        collection = Database.get_collection("threats")
+        cursor = collection.find(
+            self._grouping_query(start_time),
+            projection={
+                "mitre_attack": 1,
+                "geo.country": 1,
+                "geo.city": 1,
+                "confidence": 1,
+                "first_seen": 1,
+                "last_seen": 1,
+                "source": 1,
+                "severity": 1
+            }
+        ).batch_size(self.scan_batch_size)
+        docs = await cursor.to_list(length=None)
+        
+        # Count first so that only keys shared by multiple threats get a
+        # member list; most techniques and locations are singletons
+        technique_counts = Counter()
+        location_counts = Counter()
+        locations = []
+        for doc in docs:
+            technique_counts.update(doc.get("mitre_attack") or ())
+            geo = doc.get("geo") or {}
+            location = (str(geo["country"]).upper(), geo.get("city") or "Unknown") if geo.get("country") else None
+            locations.append(location)
+            if location:
+                location_counts[location] += 1
         
-        # Group threats by MITRE technique
         threats_by_technique = defaultdict(list)
-        for threat in threats:
-            if not threat.mitre_attack:
-                continue
-                
-            for technique in threat.mitre_attack:
-                threats_by_technique[technique].append(threat)
+        threats_by_location = defaultdict(list)
+        for doc, location in zip(docs, locations):
+            for technique in doc.get("mitre_attack") or ():
+                if technique_counts[technique] >= 2:
+                    threats_by_technique[technique].append(doc)
+            if location and location_counts[location] >= 2:
+                threats_by_location[location].append(doc)
         
-        # Create correlations for techniques with multiple associated threats
-        for technique, technique_threats in threats_by_technique.items():
-            if len(technique_threats) < 2:
+        return {
+            "by_mitre": self._summarize_groups(threats_by_technique.items()),
+            "by_geo": self._summarize_groups(
+                ({"country": country, "city": city}, members)
+                for (country, city), members in threats_by_location.items()
+            )
+        }
+    
+    def _summarize_groups(self, groups) -> List[Dict]:
+        """Build aggregation-style group summaries from (key, documents) pairs"""
+        summaries = []
+        for key, members in groups:
+            confidences = [0.5 if m.get("confidence") is None else m["confidence"] for m in members]
+            avg_conf = sum(confidences) / len(confidences)
+            if avg_conf < self.min_confidence:
                 continue
                 
-            # Calculate combined confidence and severity
-            confidence = sum(t.confidence for t in technique_threats) / len(technique_threats)
-            severity = self._calculate_combined_severity(technique_threats)
-            
-            if confidence >= self.min_confidence:
-                correlation = {
-                    "type": "mitre_technique",
-                    "description": f"{len(technique_threats)} threats associated with MITRE technique {technique}",
-                    "confidence": confidence,
-                    "severity": severity,
-                    "threats": [t.id for t in technique_threats],
-                    "first_seen": min(t.first_seen for t in technique_threats),
-                    "last_seen": max(t.last_seen for t in technique_threats),
-                    "metadata": {
-                        "mitre_technique": technique,
-                        "threat_count": len(technique_threats),
-                        "sources": list(set(t.source for t in technique_threats))
-                    }
+            summaries.append({
+                "_id": key,
+                "threat_ids": [str(m["_id"]) for m in members],
+                "count": len(members),
+                "avg_conf": avg_conf,
+                "first_seen": min((m["first_seen"] for m in members if m.get("first_seen")), default=None),
+                "last_seen": max((m["last_seen"] for m in members if m.get("last_seen")), default=None),
+                "sources": list({m.get("source") for m in members}),
+                "severities": list({m.get("severity") for m in members if m.get("severity")})
+            })
+        return summaries
+    
+    def _correlate_by_mitre_techniques(self, groups: List[Dict]) -> List[Dict]:
+        """Correlate threats by MITRE ATT&CK techniques"""
+        correlations = []
+        
+        for group in groups:
+            technique = group["_id"]
+            correlation = {
+                "type": "mitre_technique",
+                "description": f"{group['count']} threats associated with MITRE technique {technique}",
+                "confidence": group["avg_conf"],
+                "severity": self._max_severity(group["severities"]),
+                "threats": group["threat_ids"],
+                "first_seen": group["first_seen"],
+                "last_seen": group["last_seen"],
+                "metadata": {
+                    "mitre_technique": technique,
+                    "threat_count": group["count"],
+                    "sources": group["sources"]
                 }
-                correlations.append(correlation)
+            }
+            correlations.append(correlation)
         
         return correlations
     
-    async def _correlate_by_geolocation(self, threats: List[ThreatInDB]) -> List[Dict]:
+    def _correlate_by_geolocation(self, groups: List[Dict]) -> List[Dict]:
         """Correlate threats by geolocation"""
         correlations = []
         
-        # Group threats by country (using the GeoLocation.country field)
-        threats_by_country = defaultdict(list)
-        
-        for threat in threats:
-            # GeoLocation model uses `country`, not `country_code`
-            country = getattr(threat.geo, "country", None) if threat.geo else None
-            if not country:
-                continue
-                
-            country_code = str(country).upper()
-            threats_by_country[country_code].append(threat)
-        
-        # Create correlations for countries with multiple threats
-        for country_code, country_threats in threats_by_country.items():
-            if len(country_threats) < 2:
-                continue
-                
-            # Group by city if available
-            threats_by_city = defaultdict(list)
-            for threat in country_threats:
-                city = threat.geo.city if threat.geo and threat.geo.city else "Unknown"
-                threats_by_city[city].append(threat)
-            
-            # Create correlations for each city
-            for city, city_threats in threats_by_city.items():
-                if len(city_threats) < 2:
-                    continue
-                    
-                # Calculate combined confidence and severity
-                confidence = sum(t.confidence for t in city_threats) / len(city_threats)
-                severity = self._calculate_combined_severity(city_threats)
-                
-                if confidence >= self.min_confidence:
-                    correlation = {
-                        "type": "geographic",
-                        "description": f"{len(city_threats)} threats associated with {city}, {country_code}",
-                        "confidence": confidence,
-                        "severity": severity,
-                        "threats": [t.id for t in city_threats],
-                        "first_seen": min(t.first_seen for t in city_threats),
-                        "last_seen": max(t.last_seen for t in city_threats),
-                        "metadata": {
-                            "country": country_code,
-                            "city": city,
-                            "threat_count": len(city_threats),
-                            "sources": list(set(t.source for t in city_threats))
-                        }
-                    }
-                    correlations.append(correlation)
+        for group in groups:
+            country_code = group["_id"]["country"]
+            city = group["_id"]["city"]
+            correlation = {
+                "type": "geographic",
+                "description": f"{group['count']} threats associated with {city}, {country_code}",
+                "confidence": group["avg_conf"],
+                "severity": self._max_severity(group["severities"]),
+                "threats": group["threat_ids"],
+                "first_seen": group["first_seen"],
+                "last_seen": group["last_seen"],
+                "metadata": {
+                    "country": country_code,
+                    "city": city,
+                    "threat_count": group["count"],
+                    "sources": group["sources"]
+                }
+            }
+            correlations.append(correlation)
         
         return correlations
     
-    def _calculate_confidence(self, *threats: ThreatInDB) -> float:
+    async def _load_referenced_cves(self, ip_threats: List[_ThreatView], cve_map: Dict[str, _ThreatView]):
+        """Add CVEs referenced by IP threats that are missing from cve_map"""
+        missing = {
+            cve_id.upper()
+            for ip_threat in ip_threats
+            if ip_threat.enrichment
+            for cve_id in ip_threat.enrichment.get("cves") or []
+            if cve_id.upper() not in cve_map
+        }
+        if not missing:
+            return
+            
+        cursor = Database.get_collection("threats").find(
+            {"type": ThreatType.CVE.value, "value": {"$in": list(missing)}},
+            projection=self._THREAT_PROJECTION
+        )
+        for doc in await cursor.to_list(length=None):
+            cve_threat = _threat_view(doc)
+            cve_map.setdefault(cve_threat.value.upper(), cve_threat)
+    
+    async def _load_referenced(
+        self,
+        types: List[ThreatType],
+        values: Set[str],
+        lookup: Dict[str, _ThreatView],
+        key: Callable[[str], str]
+    ):
+        """Add stored threats for referenced values that are missing from lookup"""
+        missing = [value for value in values if key(value) not in lookup]
+        if not missing:
+            return
+            
+        cursor = Database.get_collection("threats").find(
+            {"type": {"$in": [t.value for t in types]}, "value": {"$in": missing}},
+            projection=self._THREAT_PROJECTION
+        )
+        for doc in await cursor.to_list(length=None):
+            threat = _threat_view(doc)
+            lookup.setdefault(key(threat.value), threat)
+    
+    async def _backfill_geolocation(self, ip_threats: List[_ThreatView]):
+        """Look up and store geolocation for IP threats that don't have one"""
+        if not ip_threats:
+            return
+            
+        try:
+            locations = await get_geolocations_bulk([t.value for t in ip_threats])
+            operations = [
+                UpdateOne(
+                    {"type": ThreatType.IP.value, "value": ip},
+                    {"$set": {"geo": GeoLocation(**location).dict()}}
+                )
+                for ip, location in locations.items()
+                if location
+            ]
+            if operations:
+                await Database.get_collection("threats").bulk_write(operations, ordered=False)
+                self.logger.info(f"Added geolocation to {len(operations)} IP threats")
+        except Exception as e:
+            self.logger.error(f"Error backfilling geolocation: {e}", exc_info=True)
+    
+    def _calculate_confidence(self, *threats: _ThreatView) -> float:
         """Calculate the confidence of a correlation between threats"""
         if not threats:
             return 0.0
@@ -407,16 +734,22 @@ class CorrelationService:
         # Cap confidence at 1.0
         return min(1.0, base_confidence)
     
-    def _calculate_combined_severity(self, threats: List[ThreatInDB]) -> str:
+    def _calculate_combined_severity(self, threats: List[_ThreatView]) -> str:
         """Calculate the combined severity of multiple threats"""
         if not threats:
             return "info"
             
         # Use the maximum severity
-        severity_order = {"critical": 4, "high": 3, "medium": 2, "low": 1, "info": 0}
-        max_severity = max(threats, key=lambda t: severity_order.get(t.severity.lower(), 0))
+        max_severity = max(threats, key=lambda t: _SEVERITY_ORDER.get(t.severity, 0))
         return max_severity.severity
     
+    def _max_severity(self, severities: List[str]) -> str:
+        """Return the highest of a list of severity names"""
+        if not severities:
+            return "info"
+        
+        return max(severities, key=lambda s: _SEVERITY_ORDER.get(s, 0))
+    
     async def _save_correlations(self, correlations: List[Dict]):
         """Save correlations to the database"""
         if not correlations:
@@ -424,113 +757,99 @@ class CorrelationService:
             
         try:
             collection = Database.get_collection("correlations")
+            now = datetime.utcnow()
+            
+            # Rank expression used to keep the higher of the stored and new severity
+            stored_rank = {"$indexOfArray": [
+                _SEVERITY_LEVELS,
+                {"$toLower": {"$ifNull": ["$severity", "info"]}}
+            ]}
             
+            # Upsert every correlation in a single batch. The updates are
+            # pipelines so that existing documents keep their original fields
+            # while confidence and severity only ever increase.
+            operations = []
             for correlation in correlations:
-                # Check if a similar correlation already exists
-                existing = await collection.find_one({
-                    "type": correlation["type"],
-                    "threats": {"$all": correlation["threats"]}
-                })
-                
-                if existing:
-                    # Update the existing correlation
-                    await collection.update_one(
-                        {"_id": existing["_id"]},
-                        {
-                            "$set": {
-                                "last_seen": correlation["last_seen"],
-                                "confidence": max(existing["confidence"], correlation["confidence"]),
-                                "severity": max(
-                                    existing["severity"], 
-                                    correlation["severity"], 
-                                    key=lambda x: ["info", "low", "medium", "high", "critical"].index(x.lower())
-                                ),
-                                "updated_at": datetime.utcnow()
-                            },
-                            "$addToSet": {
-                                "sources": {"$each": correlation["metadata"].get("sources", [])}
-                            }
-                        }
-                    )
-                else:
-                    # Insert a new correlation
-                    correlation_doc = {
-                        **correlation,
-                        "created_at": datetime.utcnow(),
-                        "updated_at": datetime.utcnow(),
-                        "sources": correlation["metadata"].get("sources", [])
-                    }
-                    await collection.insert_one(correlation_doc)
+                severity = correlation["severity"]
+                new_rank = _SEVERITY_ORDER.get(severity, 0)
+                operations.append(UpdateOne(
+                    {
+                        "type": correlation["type"],
+                        "threats": {"$all": correlation["threats"]}
+                    },
+                    [{"$set": {
+                        "type": correlation["type"],
+                        "threats": {"$ifNull": ["$threats", {"$literal": correlation["threats"]}]},
+                        "description": {"$ifNull": ["$description", {"$literal": correlation["description"]}]},
+                        "first_seen": {"$ifNull": ["$first_seen", correlation["first_seen"]]},
+                        "metadata": {"$ifNull": ["$metadata", {"$literal": correlation["metadata"]}]},
+                        "created_at": {"$ifNull": ["$created_at", now]},
+                        "last_seen": correlation["last_seen"],
+                        "updated_at": now,
+                        "confidence": {"$max": ["$confidence", correlation["confidence"]]},
+                        "severity": {"$cond": [{"$gt": [stored_rank, new_rank]}, "$severity", {"$literal": severity}]},
+                        "sources": {"$setUnion": [
+                            {"$ifNull": ["$sources", []]},
+                            {"$literal": correlation["metadata"].get("sources", [])}
+                        ]}
+                    }}],
+                    upsert=True
+                ))
+            
+            await collection.bulk_write(operations, ordered=False)
                     
         except Exception as e:
             self.logger.error(f"Error saving correlations: {e}", exc_info=True)
     
-    async def _save_threat(self, threat: ThreatIntel) -> ThreatInDB:
-        """Save a threat to the database and return the saved document"""
+    async def _save_threats(self, threats: List[ThreatIntel]) -> List[_ThreatView]:
+        """Upsert a batch of threats and return the saved documents"""
+        if not threats:
+            return []
+            
         try:
             collection = Database.get_collection("threats")
+            now = datetime.utcnow()
             
-            # Check if the threat already exists
-            existing = await collection.find_one({
-                "type": threat.type,
-                "value": threat.value
-            })
-            
-            if existing:
-                # Update the existing threat
-                update_data = {
-                    "$set": {
-                        "last_seen": threat.last_seen,
-                        "updated_at": datetime.utcnow()
-                    }
-                }
-                
-                # Update severity if higher
-                existing_severity = Severity[existing["severity"].upper()]
-                if threat.severity > existing_severity:
-                    update_data["$set"]["severity"] = threat.severity.value
-                
-                # Update confidence if higher
-                if threat.confidence > existing.get("confidence", 0):
-                    update_data["$set"]["confidence"] = threat.confidence
-                
-                # Update tags
-                if threat.tags:
-                    update_data["$addToSet"] = {"tags": {"$each": threat.tags}}
-                
-                # Update enrichment data if available
-                if threat.enrichment:
-                    update_data["$set"]["enrichment"] = threat.enrichment
-                
-                # Update MITRE ATT&CK techniques
-                if threat.mitre_attack:
-                    update_data["$addToSet"] = {"mitre_attack": {"$each": threat.mitre_attack}}
-                
-                await collection.update_one(
-                    {"_id": existing["_id"]},
-                    update_data
-                )
-                
-                # Return the updated document
-                updated = await collection.find_one({"_id": existing["_id"]})
-                return ThreatInDB(**updated)
-            else:
-                # Insert a new threat
-                threat_in_db = ThreatInDB(
+            operations = []
+            for threat in threats:
+                threat_doc = ThreatInDB(
                     **threat.dict(),
-                    created_at=datetime.utcnow(),
-                    updated_at=datetime.utcnow()
-                )
-                
-                result = await collection.insert_one(threat_in_db.dict(by_alias=True))
-                
-                # Return the saved document
-                saved = await collection.find_one({"_id": result.inserted_id})
-                return ThreatInDB(**saved)
-                
+                    created_at=now,
+                    updated_at=now
+                ).dict(by_alias=True)
+                # last_seen and updated_at are refreshed on every save, the
+                # rest is only written when the threat is first inserted
+                last_seen = threat_doc.pop("last_seen")
+                threat_doc.pop("updated_at")
+                operations.append(UpdateOne(
+                    {"type": threat.type, "value": threat.value},
+                    {
+                        "$setOnInsert": threat_doc,
+                        "$set": {"last_seen": last_seen, "updated_at": now}
+                    },
+                    upsert=True
+                ))
+            
+            # Unordered writes carry on past failed operations, so the
+            # threats that were saved are still returned
+            try:
+                await collection.bulk_write(operations, ordered=False)
+            except BulkWriteError as e:
+                for error in e.details.get("writeErrors", []):
+                    self.logger.error(
+                        f"Error saving threat {threats[error['index']].value}: {error.get('errmsg')}"
+                    )
+            
+            # Return the saved documents
+            cursor = collection.find(
+                {"value": {"$in": [t.value for t in threats]}},
+                projection=self._THREAT_PROJECTION
+            )
+            return [_threat_view(doc) async for doc in cursor]
+            
         except Exception as e:
-            self.logger.error(f"Error saving threat: {e}", exc_info=True)
-            return threat  # Return the original threat if there was an error
+            self.logger.error(f"Error saving threats: {e}", exc_info=True)
+            return []
     
     async def run(self):
         """Run the correlation service in a loop"""
@@ -1,15 +1,99 @@
 import os
+import asyncio
+import time
 import aiohttp
-from typing import Optional, Dict, Any
+from collections import OrderedDict
+from typing import Optional, Dict, Any, List
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Shared session so lookups reuse pooled keep-alive connections and cached DNS
+_session: Optional[aiohttp.ClientSession] = None
+
+async def _get_session() -> aiohttp.ClientSession:
+    """Return the shared HTTP session, creating it on first use"""
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=100, ttl_dns_cache=300),
+            timeout=aiohttp.ClientTimeout(total=5)
+        )
+    return _session
+
+# LRU cache of successful lookups, plus in-flight lookups so concurrent
+# requests for the same IP share a single HTTP call
+_GEO_CACHE_SIZE = 10000
+_geo_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_inflight: Dict[str, "asyncio.Task[Optional[Dict[str, Any]]]"] = {}
+
+# Failed lookups are remembered briefly so they aren't retried on every
+# call, and concurrent lookups are capped to stay within the API's limits
+_FAILURE_TTL = 300.0
+_failed: Dict[str, float] = {}
+_MAX_CONCURRENT_LOOKUPS = 10
+_lookup_semaphore = asyncio.Semaphore(_MAX_CONCURRENT_LOOKUPS)
+
+async def close_geolocation_session():
+    """Close the shared HTTP session"""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
 async def get_geolocation(ip_address: str) -> Optional[Dict[str, Any]]:
     """
     Get geolocation data for an IP address using ipstack.com
     Returns a dict with country, city, latitude, longitude
     """
+    cached = _geo_cache.get(ip_address)
+    if cached is not None:
+        _geo_cache.move_to_end(ip_address)
+        return cached
+    if _recently_failed(ip_address):
+        return None
+    
+    task = _inflight.get(ip_address)
+    if task is None:
+        task = asyncio.ensure_future(_lookup_geolocation(ip_address))
+        _inflight[ip_address] = task
+        task.add_done_callback(lambda _: _inflight.pop(ip_address, None))
+    
+    # Shield the shared lookup so one cancelled caller doesn't cancel it for all
+    return await asyncio.shield(task)
+
+async def get_geolocations_bulk(ip_addresses: List[str]) -> Dict[str, Optional[Dict[str, Any]]]:
+    """Get geolocation data for many IP addresses, looking up cache misses concurrently"""
+    results: Dict[str, Optional[Dict[str, Any]]] = {}
+    misses = []
+    for ip_address in dict.fromkeys(ip_addresses):
+        if ip_address in _geo_cache:
+            results[ip_address] = _geo_cache[ip_address]
+        elif _recently_failed(ip_address):
+            results[ip_address] = None
+        else:
+            misses.append(ip_address)
+    
+    if misses and not os.getenv("IPSTACK_API_KEY"):
+        logger.warning("IPSTACK_API_KEY not set in environment variables")
+        return results
+    
+    locations = await asyncio.gather(*(get_geolocation(ip_address) for ip_address in misses))
+    results.update(zip(misses, locations))
+    return results
+
+def _recently_failed(ip_address: str) -> bool:
+    """Return whether a lookup for the IP address failed within the failure TTL"""
+    failed_at = _failed.get(ip_address)
+    if failed_at is None:
+        return False
+    if time.monotonic() - failed_at < _FAILURE_TTL:
+        return True
+    del _failed[ip_address]
+    return False
+
+async def _lookup_geolocation(ip_address: str) -> Optional[Dict[str, Any]]:
+    """Query ipstack.com for an IP address and cache the result"""
     api_key = os.getenv("IPSTACK_API_KEY")
     if not api_key:
         logger.warning("IPSTACK_API_KEY not set in environment variables")
@@ -18,26 +102,34 @@ async def get_geolocation(ip_address: str) -> Optional[Dict[str, Any]]:
     url = f"http://api.ipstack.com/{ip_address}?access_key={api_key}&format=1"
     
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    if data.get("success") is False:
-                        logger.error(f"IPStack API error: {data.get('error', {}).get('info', 'Unknown error')}")
-                        return None
-                        
-                    return {
-                        "ip_address": ip_address,
-                        "country": data.get("country_name"),
-                        "city": data.get("city"),
-                        "latitude": data.get("latitude"),
-                        "longitude": data.get("longitude"),
-                        "region": data.get("region_name"),
-                        "zip": data.get("zip"),
-                    }
-                else:
-                    logger.error(f"Failed to fetch geolocation data: {response.status}")
+        session = await _get_session()
+        async with _lookup_semaphore, session.get(url) as response:
+            if response.status == 200:
+                data = await response.json()
+                if data.get("success") is False:
+                    logger.error(f"IPStack API error: {data.get('error', {}).get('info', 'Unknown error')}")
+                    return None
+                    
+                location = {
+                    "ip_address": ip_address,
+                    "country": data.get("country_name"),
+                    "city": data.get("city"),
+                    "latitude": data.get("latitude"),
+                    "longitude": data.get("longitude"),
+                    "region": data.get("region_name"),
+                    "zip": data.get("zip"),
+                }
+                _geo_cache[ip_address] = location
+                if len(_geo_cache) > _GEO_CACHE_SIZE:
+                    _geo_cache.popitem(last=False)
+                _failed.pop(ip_address, None)
+                return location
+            else:
+                logger.error(f"Failed to fetch geolocation data: {response.status}")
     except Exception as e:
         logger.error(f"Error getting geolocation: {str(e)}")
     
+    _failed[ip_address] = time.monotonic()
+    if len(_failed) > _GEO_CACHE_SIZE:
+        _failed.pop(next(iter(_failed)))
     return None
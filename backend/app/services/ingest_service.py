@@ -1,10 +1,13 @@
 import asyncio
-from datetime import datetime, timedelta
+import time
+from collections import deque
 from typing import List, Dict, Any, Optional, Set, Type, TypeVar, Generic, Callable, Awaitable
 import aiohttp
 import json
 import logging
+from contextlib import AsyncExitStack, asynccontextmanager
 from enum import Enum
+from urllib.parse import urlparse
 
 from app.ingestion.base import BaseIngestor
 from app.ingestion.nvd import NVDIngestor
@@ -13,6 +16,7 @@ from app.ingestion.otx import OTXIngestor
 from app.ingestion.abuseipdb import AbuseIPDBIngestor
 from app.ingestion.malshare import MalShareIngestor
 from app.ingestion.rss import RSSIngestor
+from app.ingestion.rate_limit import RateLimitedSession, SlidingWindowLimiter
 from app.database.models import ThreatIntel, ThreatInDB, ThreatSource
 from app.database.db import Database
 from app.app_logging import logger
@@ -30,6 +34,16 @@ class IngestorType(str, Enum):
     MALSHARE = "malshare"
     RSS = "rss"
 
+# Ingestor implementation for each ingestor type
+_INGESTOR_CLASSES: Dict[IngestorType, Type[BaseIngestor]] = {
+    IngestorType.NVD: NVDIngestor,
+    IngestorType.VIRUSTOTAL: VirusTotalIngestor,
+    IngestorType.OTX: OTXIngestor,
+    IngestorType.ABUSEIPDB: AbuseIPDBIngestor,
+    IngestorType.MALSHARE: MalShareIngestor,
+    IngestorType.RSS: RSSIngestor
+}
+
 class IngestorConfig:
     """Configuration for an ingestor"""
     def __init__(
@@ -37,31 +51,159 @@ class IngestorConfig:
         ingestor_type: IngestorType,
         enabled: bool = True,
         interval: int = 3600,  # Default: 1 hour
+        max_concurrent: Optional[int] = None,  # Concurrent requests to the provider
+        min_gap_ms: int = 0,  # Minimum time between requests to the provider
         **kwargs
     ):
         self.ingestor_type = ingestor_type
         self.enabled = enabled
         self.interval = interval
+        self.max_concurrent = max_concurrent
+        self.min_gap_ms = min_gap_ms
         self.kwargs = kwargs
 
+class RateController:
+    """Adapts an ingestor's run interval to provider backpressure (AIMD)
+    
+    The interval doubles after runs in which the provider answered with
+    rate-limit or overload statuses and steps back towards the configured
+    interval by half of it after each healthy run.
+    """
+    BACKPRESSURE_STATUSES = {429, 502, 503, 504}
+    
+    def __init__(self, interval: int, max_factor: int = 8, window: int = 5):
+        self.min_interval = float(interval)
+        self.max_interval = float(interval * max_factor)
+        self.interval = float(interval)
+        self.alpha = 0.5 * interval
+        self.beta = 0.5
+        # Runs slower than half the interval don't count as healthy
+        self.target_latency = interval / 2
+        self.latencies = deque(maxlen=window)
+    
+    def record_success(self, latency: float):
+        """Additively shorten the interval after a healthy run"""
+        self.latencies.append(latency)
+        if sum(self.latencies) / len(self.latencies) <= self.target_latency:
+            self.interval = max(self.min_interval, self.interval - self.alpha)
+    
+    def record_backpressure(self):
+        """Multiplicatively lengthen the interval after a throttled run"""
+        self.interval = min(self.max_interval, self.interval / self.beta)
+
 class IngestorManager:
     """Manages multiple threat intelligence ingestors"""
     
+    # How long a host stays throttled after a 429 without a Retry-After
+    THROTTLE_WINDOW = 60.0
+    
     def __init__(self):
         self.ingestors: Dict[str, BaseIngestor] = {}
         self.tasks: Dict[str, asyncio.Task] = {}
-        self.session: Optional[aiohttp.ClientSession] = None
+        self.session: Optional[RateLimitedSession] = None
         self.is_running = False
         self._shutdown = False
+        self._shutdown_event = asyncio.Event()
         self.logger = logging.getLogger(__name__)
+        # Per-host request quotas shared by all ingestors
+        self.limiter = SlidingWindowLimiter({
+            "www.virustotal.com": settings.VIRUSTOTAL_REQUESTS_PER_MINUTE,
+            "services.nvd.nist.gov": settings.NVD_REQUESTS_PER_MINUTE
+        })
+        # Admission control for outbound requests: a global cap, plus
+        # optional per-host caps and spacing from the ingestor configs
+        self._semaphore = asyncio.Semaphore(settings.INGESTION_MAX_CONCURRENT)
+        self._host_semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._min_gaps: Dict[str, float] = {}
+        self._next_request_at: Dict[str, float] = {}
+        # Hosts that answered 429, mapped to when that expires; they get one
+        # probe request at a time until a request succeeds or it expires
+        self._throttled_hosts: Dict[str, float] = {}
+        self._probe_locks: Dict[str, asyncio.Lock] = {}
+        # Throttling/overload responses seen per host, which the ingestors
+        # themselves only log
+        self._backpressure_counts: Dict[str, int] = {}
+    
+    def _is_throttled(self, host: str) -> bool:
+        """Check whether a host is still throttled, expiring stale entries"""
+        throttled_until = self._throttled_hosts.get(host)
+        if throttled_until is None:
+            return False
+        if time.monotonic() < throttled_until:
+            return True
+        del self._throttled_hosts[host]
+        return False
+    
+    @asynccontextmanager
+    async def _request_slot(self, host: str):
+        """Hold a global request slot, and a host slot if configured"""
+        async with AsyncExitStack() as stack:
+            # Slots are entered one at a time, so a cancelled wait only
+            # releases the slots that were actually acquired
+            await stack.enter_async_context(self._semaphore)
+            if host in self._host_semaphores:
+                await stack.enter_async_context(self._host_semaphores[host])
+            
+            # Reserve the next send slot for the host before waiting, so
+            # concurrent requests are spaced out rather than released together
+            min_gap = self._min_gaps.get(host)
+            if min_gap:
+                now = time.monotonic()
+                send_at = max(now, self._next_request_at.get(host, 0))
+                self._next_request_at[host] = send_at + min_gap
+                if send_at > now:
+                    await asyncio.sleep(send_at - now)
+            yield
+    
+    @asynccontextmanager
+    async def _admit(self, host: str):
+        """Wait until a request to the host may be sent, holding its slots while it runs"""
+        async with AsyncExitStack() as stack:
+            # While the host is throttled only one request probes it at a
+            # time; the rest queue behind it rather than all retrying
+            if self._is_throttled(host):
+                lock = self._probe_locks.setdefault(host, asyncio.Lock())
+                await lock.acquire()
+                if self._is_throttled(host):
+                    stack.callback(lock.release)
+                else:
+                    lock.release()
+            
+            await self.limiter.wait_if_throttled(host)
+            await stack.enter_async_context(self._request_slot(host))
+            yield
+    
+    def _observe(self, host: str, response: aiohttp.ClientResponse):
+        """Update the host's rate-limit state from a response"""
+        status = response.status
+        self.limiter.update_from_headers(host, response.headers)
+        if status in RateController.BACKPRESSURE_STATUSES:
+            self._backpressure_counts[host] = self._backpressure_counts.get(host, 0) + 1
+        if status == 429:
+            # Stay throttled for the provider's Retry-After, if given
+            self._throttled_hosts[host] = time.monotonic() + (
+                self.limiter.blocked_for(host) or self.THROTTLE_WINDOW
+            )
+        elif 200 <= status < 300:
+            self._throttled_hosts.pop(host, None)
     
     async def initialize(self):
         """Initialize the ingestion service"""
-        # Create an HTTP session for all ingestors to share
-        self.session = aiohttp.ClientSession(
-            timeout=aiohttp.ClientTimeout(total=30),
-            headers={'User-Agent': 'CyberIntel-X/1.0'}
-        )
+        # Create an HTTP session for all ingestors to share, keeping
+        # connections alive and caching DNS lookups across runs. Requests
+        # are admitted against the rate limits before they are sent.
+        self.session = RateLimitedSession(aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=30, sock_connect=10),
+            headers={'User-Agent': 'CyberIntel-X/1.0'},
+            connector=aiohttp.TCPConnector(
+                limit=300,
+                limit_per_host=32,
+                use_dns_cache=True,
+                ttl_dns_cache=600,
+                keepalive_timeout=60,
+                enable_cleanup_closed=True
+            )
+        ), admit=self._admit, observe=self._observe)
         
         # Create collections for tracking ingestors and tasks
         self.ingestors = {}
@@ -73,6 +215,7 @@ class IngestorManager:
         """Shutdown all ingestors and cleanup"""
         self.logger.info("Shutting down ingestion service...")
         self._shutdown = True
+        self._shutdown_event.set()
         
         # Cancel all running tasks
         for name, task in list(self.tasks.items()):
@@ -99,6 +242,7 @@ class IngestorManager:
                 ingestor_type=IngestorType.NVD,
                 enabled=True,
                 interval=settings.NVD_INGESTION_INTERVAL,
+                min_gap_ms=6000,  # NVD asks clients to wait 6s between requests
                 api_key=settings.VIRUSTOTAL_API_KEY  # Reusing VT key for NVD if needed
             ),
             IngestorType.VIRUSTOTAL: IngestorConfig(
@@ -140,14 +284,7 @@ class IngestorManager:
             return None
             
         try:
-            ingestor_class = {
-                IngestorType.NVD: NVDIngestor,
-                IngestorType.VIRUSTOTAL: VirusTotalIngestor,
-                IngestorType.OTX: OTXIngestor,
-                IngestorType.ABUSEIPDB: AbuseIPDBIngestor,
-                IngestorType.MALSHARE: MalShareIngestor,
-                IngestorType.RSS: RSSIngestor
-            }.get(config.ingestor_type)
+            ingestor_class = _INGESTOR_CLASSES.get(config.ingestor_type)
             
             if not ingestor_class:
                 self.logger.error(f"Unknown ingestor type: {config.ingestor_type}")
@@ -156,6 +293,14 @@ class IngestorManager:
             # Create the ingestor with the session and API key
             ingestor = ingestor_class(session=self.session, **config.kwargs)
             self.ingestors[config.ingestor_type.value] = ingestor
+            
+            # Apply the provider's request limits to its API host
+            host = urlparse(getattr(ingestor, "base_url", "")).hostname
+            if host:
+                if config.max_concurrent:
+                    self._host_semaphores[host] = asyncio.Semaphore(config.max_concurrent)
+                if config.min_gap_ms:
+                    self._min_gaps[host] = config.min_gap_ms / 1000
             self.logger.info(f"Created ingestor: {ingestor.name}")
             return ingestor
             
@@ -167,18 +312,29 @@ class IngestorManager:
         """Run an ingestor in a loop with the specified interval"""
         ingestor_name = ingestor.name
         self.logger.info(f"Starting ingestor: {ingestor_name} (interval: {interval}s)")
+        controller = RateController(interval)
+        host = urlparse(getattr(ingestor, "base_url", "")).hostname
         
         while not self._shutdown:
             try:
-                start_time = datetime.utcnow()
+                start_time = time.monotonic()
+                backpressure_before = self._backpressure_counts.get(host, 0)
                 self.logger.info(f"Running ingestor: {ingestor_name}")
                 
                 # Run the ingester
                 await ingestor.run()
                 
+                # Back off harder if the provider throttled us during the
+                # run, even though the ingestor handled those responses
+                elapsed = time.monotonic() - start_time
+                if self._backpressure_counts.get(host, 0) > backpressure_before:
+                    controller.record_backpressure()
+                    self.logger.warning(f"Ingestor {ingestor_name} was throttled by {host}")
+                else:
+                    controller.record_success(elapsed)
+                
                 # Calculate sleep time to maintain the interval
-                elapsed = (datetime.utcnow() - start_time).total_seconds()
-                sleep_time = max(0, interval - elapsed)
+                sleep_time = max(0, controller.interval - elapsed)
                 
                 self.logger.info(f"Ingestor {ingestor_name} completed in {elapsed:.2f}s. Next run in {sleep_time:.2f}s")
                 
@@ -201,6 +357,7 @@ class IngestorManager:
             
         self.is_running = True
         self._shutdown = False
+        self._shutdown_event.clear()
         
         try:
             await self.initialize()
@@ -208,13 +365,19 @@ class IngestorManager:
             # Get ingestor configurations
             configs = self.get_ingestor_configs()
             
-            # Create and start ingestors
+            enabled_configs = []
             for config in configs.values():
                 if not config.enabled:
                     self.logger.info(f"Skipping disabled ingestor: {config.ingestor_type.value}")
                     continue
-                
-                ingestor = await self.create_ingestor(config)
+                enabled_configs.append(config)
+            
+            # Create and start ingestors together; the shared session's
+            # limits smooth out their outgoing requests
+            ingestors = await asyncio.gather(
+                *(self.create_ingestor(config) for config in enabled_configs)
+            )
+            for config, ingestor in zip(enabled_configs, ingestors):
                 if not ingestor:
                     continue
                 
@@ -224,15 +387,11 @@ class IngestorManager:
                     name=f"ingestor_{config.ingestor_type.value}"
                 )
                 self.tasks[config.ingestor_type.value] = task
-                
-                # Add a small delay between starting ingestors
-                await asyncio.sleep(1)
             
             self.logger.info(f"Started {len(self.tasks)} ingestors")
             
-            # Keep the service running
-            while not self._shutdown:
-                await asyncio.sleep(1)
+            # Keep the service running until shutdown is requested
+            await self._shutdown_event.wait()
                 
         except asyncio.CancelledError:
             self.logger.info("Ingestion service was cancelled")
@@ -0,0 +1,64 @@
+import asyncio
+from typing import Awaitable, Callable, Optional
+
+import redis.asyncio as redis
+
+from app.app_logging import logger
+
+class RedisRelay:
+    """Redis pub/sub relay carrying messages between workers
+
+    Messages published on any channel matching the pattern, by any worker
+    including this one, are passed to the handler with their channel.
+    """
+
+    def __init__(self, url: str, pattern: str, handler: Callable[[str, str], Awaitable[None]]):
+        self.url = url
+        self.pattern = pattern
+        self._handler = handler
+        self._redis: Optional[redis.Redis] = None
+        self._pubsub_task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._redis is not None
+
+    async def start(self):
+        """Connect to Redis and start relaying published messages"""
+        if self._redis is None:
+            self._redis = redis.from_url(self.url, decode_responses=True)
+            self._pubsub_task = asyncio.create_task(self._pump_pubsub())
+
+    async def stop(self):
+        """Stop relaying and close the connection"""
+        if self._pubsub_task is not None:
+            self._pubsub_task.cancel()
+            try:
+                await self._pubsub_task
+            except asyncio.CancelledError:
+                pass
+            self._pubsub_task = None
+        if self._redis is not None:
+            await self._redis.aclose()
+            self._redis = None
+
+    async def publish(self, channel: str, message: str):
+        """Publish a message to every worker's relay"""
+        await self._redis.publish(channel, message)
+
+    async def _pump_pubsub(self):
+        """Pass published messages to the handler, resubscribing after errors"""
+        while True:
+            pubsub = self._redis.pubsub()
+            try:
+                await pubsub.psubscribe(self.pattern)
+                async for message in pubsub.listen():
+                    if message["type"] == "pmessage":
+                        await self._handler(message["channel"], message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error relaying messages from Redis: {e}")
+                await asyncio.sleep(5)
+            finally:
+                await pubsub.aclose()
@@ -1,20 +1,64 @@
 import asyncio
 import json
 import logging
-from typing import Dict, List, Optional, Set, Any, Callable, Awaitable
+import time
+import orjson
+from collections import defaultdict
+from functools import lru_cache
+from typing import Dict, List, Optional, Set, Any, Callable, Awaitable, Union
 from datetime import datetime, timedelta
 from uuid import UUID, uuid4
 
 from fastapi import WebSocket, WebSocketDisconnect
-from pydantic import BaseModel, Field
+from fastapi.websockets import WebSocketState
+from pydantic import BaseModel, Field, TypeAdapter
 
 from app.app_logging import logger
-from app.database.models import ThreatIntel, Alert, UserInDB, ThreatType, Severity
+from app.config import settings
+from app.database.models import ThreatIntel, Alert, User, ThreatType, Severity
 from app.database.db import Database
+from app.services.redis_relay import RedisRelay
+
+def _encode(data: dict) -> str:
+    """Encode a message as JSON text"""
+    # Messages stay text frames since clients JSON.parse them
+    return orjson.dumps(data, default=str).decode()
+
+@lru_cache(maxsize=None)
+def _threat_adapter(model: type) -> TypeAdapter:
+    """Return the cached serializer for a threat model class"""
+    return TypeAdapter(model)
+
+def _encode_threat(threat: ThreatIntel) -> str:
+    """Encode a threat update message for the threat's channel"""
+    # Serialize the model straight to JSON rather than via .dict()
+    return (
+        b'{"channel":' + orjson.dumps(f"threats:{threat.type.value}")
+        + b',"type":"threat_update","threat":'
+        + _threat_adapter(type(threat)).dump_json(threat)
+        + b'}'
+    ).decode()
 
 class ConnectionManager:
     """Manages WebSocket connections and message broadcasting"""
     
+    __slots__ = (
+        "active_connections",
+        "user_connections",
+        "connection_users",
+        "subscriptions",
+        "connection_subscriptions",
+        "message_handlers",
+        "connection_timeout",
+        "sweep_interval",
+        "_last_activity",
+        "_sweeper",
+        "_relay",
+        "send_queue_size",
+        "_queues",
+        "_writers"
+    )
+    
     def __init__(self):
         self.active_connections: Dict[str, WebSocket] = {}
         self.user_connections: Dict[str, Set[str]] = defaultdict(set)  # user_id -> set of connection_ids
@@ -22,22 +66,71 @@ class ConnectionManager:
         self.subscriptions: Dict[str, Set[str]] = defaultdict(set)  # channel -> set of connection_ids
         self.connection_subscriptions: Dict[str, Set[str]] = defaultdict(set)  # connection_id -> set of channels
         self.message_handlers = {}
-        self.connection_timeouts: Dict[str, asyncio.Task] = {}
         self.connection_timeout = 300  # 5 minutes
+        self.sweep_interval = 30
+        self._last_activity: Dict[str, float] = {}  # connection_id -> monotonic time of last activity
+        self._sweeper: Optional[asyncio.Task] = None
+        # Optional Redis backplane relaying channel broadcasts between workers
+        self._relay: Optional[RedisRelay] = (
+            RedisRelay(settings.REDIS_URL, "ws:*", self._relay_broadcast) if settings.REDIS_URL else None
+        )
+        # Outbound message queues, each drained by a writer task, so a slow
+        # client can't hold up sends to the others
+        self.send_queue_size = 1000
+        self._queues: Dict[str, asyncio.Queue] = {}
+        self._writers: Dict[str, asyncio.Task] = {}
         
         # Register default message handlers
         self.register_handler("ping", self._handle_ping)
         self.register_handler("subscribe", self._handle_subscribe)
         self.register_handler("unsubscribe", self._handle_unsubscribe)
     
-    async def connect(self, websocket: WebSocket, user: UserInDB = None):
+    async def start(self):
+        """Start closing idle connections and relaying broadcasts in the background"""
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.create_task(self._sweep_idle())
+        
+        if self._relay is not None:
+            await self._relay.start()
+    
+    async def stop(self):
+        """Stop the background tasks"""
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            try:
+                await self._sweeper
+            except asyncio.CancelledError:
+                pass
+        self._sweeper = None
+        
+        if self._relay is not None:
+            await self._relay.stop()
+    
+    async def _relay_broadcast(self, redis_channel: str, data: str):
+        """Relay a channel broadcast published by any worker to local connections"""
+        # Published as the excluded connection IDs, a newline, then the
+        # encoded message
+        exclude, payload = data.split("\n", 1)
+        await self._local_broadcast(
+            redis_channel[len("ws:"):],
+            payload,
+            exclude.split(",") if exclude else None
+        )
+    
+    async def connect(self, websocket: WebSocket, user: User = None):
         """Accept a new WebSocket connection"""
+        await self.start()
         await websocket.accept()
         
         # Generate a unique connection ID
         connection_id = str(uuid4())
         self.active_connections[connection_id] = websocket
         
+        # Start the connection's writer
+        queue = asyncio.Queue(maxsize=self.send_queue_size)
+        self._queues[connection_id] = queue
+        self._writers[connection_id] = asyncio.create_task(self._writer(connection_id, websocket, queue))
+        
         # Associate user with connection if authenticated
         user_id = str(user.id) if user else "anonymous"
         self.connection_users[connection_id] = user_id
@@ -52,48 +145,59 @@ class ConnectionManager:
     
     def disconnect(self, connection_id: str):
         """Handle disconnection"""
-        if connection_id in self.active_connections:
-            # Remove from active connections
-            websocket = self.active_connections.pop(connection_id, None)
-            
-            # Clean up user association
-            user_id = self.connection_users.pop(connection_id, None)
-            if user_id and user_id in self.user_connections:
-                self.user_connections[user_id].discard(connection_id)
-                if not self.user_connections[user_id]:
-                    del self.user_connections[user_id]
-            
-            # Clean up subscriptions
-            for channel in self.connection_subscriptions.get(connection_id, set()):
-                self.subscriptions[channel].discard(connection_id)
-                if not self.subscriptions[channel]:
-                    del self.subscriptions[channel]
-            
-            if connection_id in self.connection_subscriptions:
-                del self.connection_subscriptions[connection_id]
-            
-            # Cancel timeout task
-            if connection_id in self.connection_timeouts:
-                self.connection_timeouts[connection_id].cancel()
-                del self.connection_timeouts[connection_id]
-            
-            logger.info(f"WebSocket disconnected: {connection_id} (User: {user_id or 'unknown'})")
+        # Remove from active connections
+        if self.active_connections.pop(connection_id, None) is None:
+            return
+        
+        # Clean up user association
+        user_id = self.connection_users.pop(connection_id, None)
+        user_connections = self.user_connections
+        connections = user_connections.get(user_id)
+        if connections is not None:
+            connections.discard(connection_id)
+            if not connections:
+                user_connections.pop(user_id, None)
+        
+        # Clean up subscriptions without creating entries in the defaultdicts
+        subscriptions = self.subscriptions
+        for channel in self.connection_subscriptions.pop(connection_id, ()):
+            subscribers = subscriptions.get(channel)
+            if subscribers is not None:
+                subscribers.discard(connection_id)
+                if not subscribers:
+                    subscriptions.pop(channel, None)
+        
+        # Stop tracking activity and the writer
+        self._last_activity.pop(connection_id, None)
+        self._queues.pop(connection_id, None)
+        writer = self._writers.pop(connection_id, None)
+        if writer is not None and writer is not asyncio.current_task():
+            writer.cancel()
+        
+        logger.info(f"WebSocket disconnected: {connection_id} (User: {user_id or 'unknown'})")
     
     def _reset_connection_timeout(self, connection_id: str):
         """Reset the connection timeout"""
-        # Cancel existing timeout if any
-        if connection_id in self.connection_timeouts:
-            self.connection_timeouts[connection_id].cancel()
-        
-        # Set a new timeout
-        self.connection_timeouts[connection_id] = asyncio.create_task(
-            self._connection_timeout(connection_id)
-        )
+        self._last_activity[connection_id] = time.monotonic()
+    
+    async def _sweep_idle(self):
+        """Periodically close connections that have been idle too long"""
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            now = time.monotonic()
+            idle = [
+                connection_id
+                for connection_id, last_activity in self._last_activity.items()
+                if now - last_activity > self.connection_timeout
+            ]
+            if idle:
+                await asyncio.gather(
+                    *(self._connection_timeout(connection_id) for connection_id in idle)
+                )
     
     async def _connection_timeout(self, connection_id: str):
         """Handle connection timeout"""
         try:
-            await asyncio.sleep(self.connection_timeout)
             if connection_id in self.active_connections:
                 logger.info(f"Connection {connection_id} timed out")
                 await self.send_json(
@@ -101,9 +205,6 @@ class ConnectionManager:
                     {"type": "error", "message": "Connection timed out due to inactivity"}
                 )
                 await self.close_connection(connection_id, 1000, "Connection timed out")
-        except asyncio.CancelledError:
-            # Timeout was reset
-            pass
         except Exception as e:
             logger.error(f"Error in connection timeout handler: {e}")
     
@@ -112,6 +213,13 @@ class ConnectionManager:
         if connection_id in self.active_connections:
             websocket = self.active_connections[connection_id]
             try:
+                # Give queued messages a moment to go out first
+                queue = self._queues.get(connection_id)
+                if queue is not None:
+                    try:
+                        await asyncio.wait_for(queue.join(), timeout=1.0)
+                    except asyncio.TimeoutError:
+                        pass
                 await websocket.close(code=code, reason=reason)
             except Exception as e:
                 logger.error(f"Error closing WebSocket {connection_id}: {e}")
@@ -120,36 +228,89 @@ class ConnectionManager:
     
     async def send_json(self, connection_id: str, data: dict):
         """Send a JSON message to a specific connection"""
-        if connection_id in self.active_connections:
+        return self._enqueue(connection_id, _encode(data))
+    
+    def _enqueue(self, connection_id: str, payload: str) -> bool:
+        """Queue an encoded message for a connection's writer"""
+        queue = self._queues.get(connection_id)
+        if queue is None:
+            return False
+        
+        # Drop connections the client has already closed without raising
+        if self.active_connections[connection_id].client_state != WebSocketState.CONNECTED:
+            self.disconnect(connection_id)
+            return False
+        
+        try:
+            queue.put_nowait(payload)
+            return True
+        except asyncio.QueueFull:
+            # The client isn't keeping up; stop queueing for it and close it
+            logger.warning(f"Send queue full for {connection_id}, closing slow connection")
+            del self._queues[connection_id]
+            asyncio.create_task(self.close_connection(connection_id, 1013, "Client too slow"))
+            return False
+    
+    async def _writer(self, connection_id: str, websocket: WebSocket, queue: asyncio.Queue):
+        """Send a connection's queued messages in order"""
+        while True:
+            payload = await queue.get()
             try:
-                await self.active_connections[connection_id].send_json(data)
+                await websocket.send_text(payload)
                 self._reset_connection_timeout(connection_id)
-                return True
             except Exception as e:
                 logger.error(f"Error sending message to {connection_id}: {e}")
                 self.disconnect(connection_id)
-        return False
+                return
+            finally:
+                queue.task_done()
+    
+    async def _send_many(self, connection_ids: List[str], payload: str):
+        """Queue an encoded message for multiple connections"""
+        for connection_id in connection_ids:
+            self._enqueue(connection_id, payload)
     
     async def broadcast_json(self, data: dict, connection_ids: List[str] = None):
         """Send a JSON message to multiple connections"""
         if connection_ids is None:
             connection_ids = list(self.active_connections.keys())
         
-        for connection_id in connection_ids[:]:  # Create a copy to allow modification during iteration
-            await self.send_json(connection_id, data)
+        # Encode once for all recipients
+        await self._send_many(connection_ids, _encode(data))
     
-    async def broadcast_to_channel(self, channel: str, data: dict, exclude: List[str] = None):
-        """Broadcast a message to all connections subscribed to a channel"""
+    async def broadcast_to_channel(self, channel: str, data: Union[dict, str], exclude: List[str] = None):
+        """Broadcast a message to all connections subscribed to a channel
+        
+        data may also be an already encoded message, which is sent as is.
+        With a Redis backplane the message reaches subscribers on every worker.
+        """
+        if self._relay is not None:
+            await self.start()
+            payload = data if isinstance(data, str) else _encode({"channel": channel, **data})
+            try:
+                await self._relay.publish(f"ws:{channel}", ",".join(exclude or []) + "\n" + payload)
+                return
+            except Exception as e:
+                logger.error(f"Error publishing to Redis, broadcasting locally: {e}")
+            await self._local_broadcast(channel, payload, exclude)
+        elif channel in self.subscriptions:
+            await self._local_broadcast(channel, data, exclude)
+    
+    async def _local_broadcast(self, channel: str, data: Union[dict, str], exclude: List[str] = None):
+        """Broadcast a message to this worker's connections subscribed to a channel"""
         if channel in self.subscriptions:
             exclude_set = set(exclude or [])
-            for connection_id in self.subscriptions[channel] - exclude_set:
-                await self.send_json(connection_id, {"channel": channel, **data})
+            # Encode once for all subscribers
+            payload = data if isinstance(data, str) else _encode({"channel": channel, **data})
+            await self._send_many(list(self.subscriptions[channel] - exclude_set), payload)
     
     async def send_to_user(self, user_id: str, data: dict):
         """Send a message to all connections of a specific user"""
         if user_id in self.user_connections:
-            for connection_id in self.user_connections[user_id]:
-                await self.send_json(connection_id, {"user_message": True, **data})
+            await self._send_many(
+                list(self.user_connections[user_id]),
+                _encode({"user_message": True, **data})
+            )
     
     async def handle_message(self, connection_id: str, message: dict):
         """Handle an incoming WebSocket message"""
@@ -257,10 +418,7 @@ class NotificationService:
         """Send a threat update to all subscribed clients"""
         await websocket_manager.broadcast_to_channel(
             f"threats:{threat.type.value}",
-            {
-                "type": "threat_update",
-                "threat": threat.dict()
-            }
+            _encode_threat(threat)
         )
     
     @staticmethod
@@ -272,8 +430,9 @@ class NotificationService:
         }
         
         if user_ids:
-            for user_id in user_ids:
-                await websocket_manager.send_to_user(user_id, alert_data)
+            await asyncio.gather(
+                *(websocket_manager.send_to_user(user_id, alert_data) for user_id in user_ids)
+            )
         else:
             # Broadcast to all connections subscribed to alerts
             await websocket_manager.broadcast_to_channel("alerts", alert_data)
@@ -289,8 +448,9 @@ class NotificationService:
         }
         
         if user_ids:
-            for user_id in user_ids:
-                await websocket_manager.send_to_user(user_id, message_data)
+            await asyncio.gather(
+                *(websocket_manager.send_to_user(user_id, message_data) for user_id in user_ids)
+            )
         else:
             # Broadcast to all connections
             await websocket_manager.broadcast_json(message_data)
@@ -311,7 +471,7 @@ class NotificationService:
 notification_service = NotificationService()
 
 
-async def websocket_endpoint(websocket: WebSocket, user: UserInDB = None):
+async def websocket_endpoint(websocket: WebSocket, user: User = None):
     """Handle WebSocket connections"""
     connection_id = await websocket_manager.connect(websocket, user)
     
@@ -323,7 +483,7 @@ async def websocket_endpoint(websocket: WebSocket, user: UserInDB = None):
                 
                 try:
                     # Try to parse the message as JSON
-                    message = json.loads(data)
+                    message = orjson.loads(data)
                     await websocket_manager.handle_message(connection_id, message)
                 except json.JSONDecodeError:
                     # If not JSON, treat as raw text (e.g., simple ping)
@@ -8,11 +8,23 @@ sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'backend'))
 os.environ['PYTHONPATH'] = os.path.join(os.path.dirname(__file__), 'backend')
 
 try:
-    from app.main import app
+    from app.config import settings
     import uvicorn
     
     if __name__ == "__main__":
-        uvicorn.run(app, host="0.0.0.0", port=8000)
+        # Workers each run their own event loop (and background services),
+        # so the count defaults to the WORKERS setting
+        uvicorn.run(
+            "app.main:app",
+            host=settings.HOST,
+            port=settings.PORT,
+            workers=int(os.environ.get("WEB_CONCURRENCY", settings.WORKERS)),
+            # uvloop/httptools when installed (not on Windows), asyncio/h11 otherwise
+            loop="auto",
+            http="auto",
+            ws="websockets",
+            log_level=settings.LOG_LEVEL.lower()
+        )
 except ImportError as e:
     print(f"Import error: {e}")
     print("Please make sure all dependencies are installed.")